@@ -10,11 +10,32 @@
 
 import sys
 import os
+import io
 import time
+import traceback
+import zlib
+import json
+import re
+import hashlib
+import mmap
+import struct
+import math
+import queue
+import threading
+import tempfile
+from array import array
 import zipfile as zipf
 import argparse as ap
 from enum import Enum
+from itertools import combinations, chain, islice
 from fnmatch import fnmatch
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+	import numpy as np  # optional, only needed for '-c geometry'
+except ImportError:
+	np = None
 
 echo = print  # just to differentiate from debug prints
 
@@ -38,10 +59,83 @@ VALID_UNUSED_XDATA_FILES = [
 
 REPORT_HEADER = "\n\n  Some {} were not found in the maps\n"  # .format(name)
 REPORT_FILE   = "    > in file: {}"    # .format(file)
+REPORT_MAP    = "    > in map: {}"     # .format(map)
 REPORT_OBJECT = "        {}"    # .format(object)
 REPORT_COUNT  = "\n  {} {}\n"   # .format(amount, name)
 REPORT_OK     = "all Ok"
 
+MODEL_EXTENSIONS = [".ase", ".lwo", ".obj", ".md5mesh", ".ma", ".flt"]
+SCANNED_MODEL_EXTENSIONS = [".ase", ".lwo", ".md5mesh"]  # the materials are read from these
+IMAGE_EXTENSIONS = [".tga", ".dds", ".png", ".jpg"]
+
+# per map limits for '-c budget', can be changed with '--limits'
+BUDGET_LIMITS = {
+	"entities"      : 8000,
+	"brushes"       : 20000,
+	"patches"       : 5000,
+	"func_statics"  : 3000,
+	"lights"        : 500,
+	"shadow_lights" : 250,
+	"big_lights"    : 20,    # lights with a radius above 'LARGE_LIGHT_RADIUS'
+	"materials"     : 600,
+	"light_overlap" : 4,     # other lights a light can overlap with, see '-c overlap'
+}
+LARGE_LIGHT_RADIUS = 1024
+BUDGET_TOP_COUNT   = 10
+
+MAX_TEXTURE_SIZE = 2048
+
+# bytes per pixel of the compressed dds formats
+DDS_FORMAT_BPP = {
+	"DXT1": 0.5, "BC1": 0.5, "ATI1": 0.5, "BC4U": 0.5,
+	"DXT3": 1.0, "DXT5": 1.0, "ATI2": 1.0, "BC5U": 1.0, "BC7": 1.0,
+}
+
+TINY_BRUSH_SIZE = 1.0   # brushes thinner than this are reported by '-c geometry'
+
+SOUND_EXTENSIONS   = [".ogg", ".wav"]
+MAX_SOUND_DURATION = 60   # seconds, longer sounds are reported by '-c sounds'
+
+# gui properties that take a material or sound shader
+GUI_REF_KEYS = ["background", "mat", "snd"]
+
+# materials the engine provides without a declaration
+IMPLICIT_MATERIALS = ["_default", "_emptyname", "_white", "_black", "_flat"]
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# fixed values for deterministic builds (see '--deterministic')
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)   # the earliest date zip supports
+DETERMINISTIC_FILE_ATTR = 0o100644 << 16          # regular file, rw-r--r--
+MANIFEST_EXT = ".manifest"
+MEGABYTE        = 1024 * 1024
+
+PROGRESS_INTERVAL     = 0.1  # seconds between redraws of the progress line
+PROGRESS_LOG_INTERVAL = 5.0  # same, when the output isn't a console (logs, CI)
+PACK_QUEUE_SIZE       = 256  # files found by the walker and not yet packed
+
+# text files that '--minify' strips of comments and whitespace
+MINIFY_EXTENSIONS = [".mtr", ".def", ".skin", ".prt", ".gui", ".script", ".xd"]
+MINIFY_TOP_COUNT  = 10   # files listed in the savings report, unless verbose
+MINIFY_PUNCTUATION = set("{}()[],;")  # no space is needed next to these
+
+# dmap output for a map, '.aas' also matches '.aas32', '.aas48', etc.
+COMPILED_MAP_EXTENSIONS = [".proc", ".cm", ".aas"]
+
+# decl files that '--strip_unused' leaves the unused decls out of
+STRIP_DECL_EXTENSIONS = [".mtr", ".skin", ".prt", ".xd"]
+
+# (memLevel, strategy) tried on every file with '--release'. The first one is
+# what zipfile uses for level 9, the baseline the savings are reported against
+RELEASE_DEFLATE_PARAMS = [
+	(8, zlib.Z_DEFAULT_STRATEGY),
+	(9, zlib.Z_DEFAULT_STRATEGY),
+	(8, zlib.Z_FILTERED),
+	(9, zlib.Z_FILTERED),
+	(9, zlib.Z_RLE),
+	(9, zlib.Z_HUFFMAN_ONLY),
+]
+
 PKIGNORE_FILENAME    = ".pkignore"
 MODFILE_FILENAME     = "darkmod.txt"
 README_FILENAME      = "readme.txt"
@@ -49,19 +143,52 @@ STARTMAP_FILENAME    = "startingmap.txt"
 MAPSEQUENCE_FILENAME = "tdm_mapsequence.txt"
 BRIEFING_FILENAME    = "xdata/briefing.xd"
 
+USER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".fmpak_cache")
+MISSION_CACHE_DIRNAME = ".fmpak"
+
 # make sure to exclude any meta stuff
-ignored_folders = set(["savegames", "__pycache__", ".git"])
-ignored_files = set([
+DEFAULT_IGNORED_FOLDERS = ["savegames", "__pycache__", ".git", MISSION_CACHE_DIRNAME]
+DEFAULT_IGNORED_FILES = [
 	PKIGNORE_FILENAME, ".lin", "bak", ".log", ".dat", ".py", ".pyc",
 	".pk4", ".zip", ".7z", ".rar", ".gitignore", ".gitattributes"
-])
+]
+
+ignored_folders = set(DEFAULT_IGNORED_FOLDERS)
+ignored_files = set(DEFAULT_IGNORED_FILES)
 
 
 class FileGroup:
-	def __init__(self, files, dir_count, file_count):
-		self.files      = files
-		self.dir_count  = dir_count
-		self.file_count = file_count
+	# kept as parallel arrays instead of an object per file, since FMs with
+	# source art in them can have hundreds of thousands of files
+	def __init__(self, root):
+		self.root       = root
+		self.dirs       = []          # relative dir paths, each stored once
+		self.dir_ids    = array('I')  # per file, index into 'dirs'
+		self.names      = []
+		self.sizes      = array('q')
+		self.mtimes     = array('d')
+		self.dir_count  = 0
+		self.file_count = 0
+
+	def add_dir(self, reldir):
+		self.dirs.append(reldir)
+		return len(self.dirs) - 1
+
+	def add_file(self, dir_id, name, size, mtime):
+		self.dir_ids.append(dir_id)
+		self.names.append(name)
+		self.sizes.append(size)
+		self.mtimes.append(mtime)
+		self.file_count += 1
+
+	def get_relpath(self, i):
+		reldir = self.dirs[self.dir_ids[i]]
+		return os.path.join(reldir, self.names[i]) if reldir else self.names[i]
+
+	@property
+	def files(self):
+		# views are created on demand, nothing per file is kept around
+		return ( MissionFile(self, i) for i in range(len(self.names)) )
 
 class mission: # data class to avoid using 'global'
 	path    = ""
@@ -70,11 +197,30 @@ class mission: # data class to avoid using 'global'
 	excluded : FileGroup
 	map_names = []
 	warning_count = 0
+	unused_decls = {}  # { fullpath : [(start, end, name)] }, see '--strip_unused'
+	entity_defs  = None  # EntityDefResolver, see load_entity_defs()
+
+class base: # data class for the stock assets of the game (see '--base')
+	path  = ""
+	files = None  # { lowercase archive path : (size, crc) }
+	decls = None  # { decl kind : set of lowercase names }
+	defs  = None  # { lowercase entityDef name : own key/values }
 
 class MissionFile:
-	def __init__(self, fullpath, relpath):
-		self.fullpath = fullpath
-		self.relpath = relpath
+	__slots__ = ("group", "index")
+
+	def __init__(self, group, index):
+		self.group = group
+		self.index = index
+
+	@property
+	def relpath(self):  return self.group.get_relpath(self.index)
+	@property
+	def fullpath(self): return os.path.join(self.group.root, self.relpath)
+	@property
+	def size(self):     return self.group.sizes[self.index]
+	@property
+	def mtime(self):    return self.group.mtimes[self.index]
 
 
 
@@ -109,6 +255,20 @@ def parse_path(dir):
 	return path
 
 
+def reset_mission():
+	# needed when more than one mission is handled by the same process
+	mission.path = ""
+	mission.name = ""
+	mission.map_names = []
+	mission.warning_count = 0
+	mission.unused_decls = {}
+	mission.entity_defs  = None
+	ignored_folders.clear()
+	ignored_folders.update(DEFAULT_IGNORED_FOLDERS)
+	ignored_files.clear()
+	ignored_files.update(DEFAULT_IGNORED_FILES)
+
+
 def set_fm_path(path):
 	mission.path = parse_path(path)
 	mission.name = os.path.basename(mission.path)
@@ -175,6 +335,154 @@ def get_filenames_in_dir_recursive(dir_path:str, patterns=[]):
 	return dir_files
 
 
+def get_worker_count():
+	if args.jobs: return args.jobs
+	return os.cpu_count() or 1
+
+
+def get_arcname(relpath):
+	return relpath.replace('\\', '/')
+
+
+def get_file_crc32(path):
+	crc = 0
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(READ_CHUNK_SIZE)
+			if not chunk: break
+			crc = zlib.crc32(chunk, crc)
+	return crc
+
+
+def get_file_sha256(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(READ_CHUNK_SIZE)
+			if not chunk: break
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def hash_files(hash_func, paths):
+	# zlib and hashlib release the GIL while hashing, so threads are enough here
+	with ThreadPoolExecutor(max_workers=get_worker_count()) as executor:
+		return dict(zip(paths, executor.map(hash_func, paths)))
+
+
+def get_crc32_of_files(paths):
+	return hash_files(get_file_crc32, paths)
+
+
+def read_pk4_index(pk4_path):
+	# only the central directory is read, nothing gets decompressed
+	index = {}
+	with zipf.ZipFile(pk4_path, 'r') as f:
+		for info in f.infolist():
+			if info.is_dir(): continue
+			index[info.filename] = (info.file_size, info.CRC)
+	return index
+
+
+def read_pk4_decls(pk4_path):
+	# the only part of the base pk4s that has to be decompressed, and it's
+	# cached: the decl names, and the key/values of the entityDefs
+	decls = {}
+	defs = {}
+	with zipf.ZipFile(pk4_path, 'r') as f:
+		for info in f.infolist():
+			ext = os.path.splitext(info.filename)[1].lower()
+			if not ext in DECL_KINDS: continue
+			text = f.read(info).decode("latin-1")
+			for kind, names in get_decl_names(text, ext).items():
+				if not kind in decls: decls[kind] = []
+				decls[kind] += names
+			if ext == ".def":
+				defs.update(parse_entity_defs(text))
+	return decls, defs
+
+
+def load_json_cache(cache_path):
+	if not os.path.isfile(cache_path): return None
+	try:
+		with open(cache_path, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None  # a broken cache is just rebuilt
+
+
+def save_json_cache(cache_path, data):
+	cache_dir = os.path.dirname(cache_path)
+	os.makedirs(cache_dir, exist_ok=True)
+	# a unique temp file, since batch workers can save the same cache at once
+	fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(cache_path), suffix=".tmp")
+	try:
+		with os.fdopen(fd, 'w') as f:
+			json.dump(data, f)
+		os.replace(tmp_path, cache_path)
+	except BaseException:
+		if os.path.exists(tmp_path): os.remove(tmp_path)
+		raise
+
+
+def get_mission_cache_path(filename):
+	return os.path.join(mission.path, MISSION_CACHE_DIRNAME, filename)
+
+
+def load_base_index(tdm_path):
+	if not os.path.isdir(tdm_path):
+		error(f"invalid base game path '{tdm_path}'")
+
+	pk4_names = sorted(n for n in os.listdir(tdm_path) if n.lower().endswith(".pk4"))
+	if not pk4_names:
+		error(f"no pk4 files found in base game path '{tdm_path}'")
+
+	cache_name = "base_{:08x}.json".format(zlib.crc32(os.path.abspath(tdm_path).encode()))
+	cache_path = os.path.join(USER_CACHE_PATH, cache_name)
+	cache = load_json_cache(cache_path) or {}
+
+	# only the pk4s that changed since the last run are read again
+	new_cache = {}
+	changed = False
+	for name in pk4_names:
+		st = os.stat(os.path.join(tdm_path, name))
+		entry = cache.get(name)
+		if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime \
+		or not "defs" in entry:
+			if args.verbose: echo(f"    indexing '{name}'")
+			pk4_path = os.path.join(tdm_path, name)
+			decls, defs = read_pk4_decls(pk4_path)
+			entry = {
+				"size"  : st.st_size,
+				"mtime" : st.st_mtime,
+				"files" : read_pk4_index(pk4_path),
+				"decls" : decls,
+				"defs"  : defs,
+			}
+			changed = True
+		new_cache[name] = entry
+
+	if changed or len(new_cache) != len(cache):
+		save_json_cache(cache_path, new_cache)
+
+	# pk4s are loaded in alphabetical order, so later ones override earlier ones
+	files = {}
+	decls = {}
+	defs  = {}
+	for name in pk4_names:
+		for path, (size, crc) in new_cache[name]["files"].items():
+			files[path.lower()] = (size, crc)
+		for kind, names in new_cache[name]["decls"].items():
+			if not kind in decls: decls[kind] = set()
+			decls[kind].update(n.lower() for n in names)
+		defs.update(new_cache[name]["defs"])
+
+	base.path  = tdm_path
+	base.files = files
+	base.decls = decls
+	base.defs  = defs
+
+
 def should_ignore(path, filters):
 	for string in filters:
 		if string in path:
@@ -244,33 +552,55 @@ def add_ignored_maps():
 				ignored_files.add(f)
 
 
-def gather_files():
-	inc, exc = [], []
-	num_inc_dirs, num_inc_files = -1, 0
-	num_exc_dirs, num_exc_files = -1, 0
+def add_ignored_pack_log():
+	# the log is written relative to the current dir, which can be the
+	# mission's, and it mustn't end up in the next pk4
+	if not args.pack_log: return
+	relpath = os.path.relpath(os.path.abspath(args.pack_log), mission.path)
+	if not relpath.startswith(".."):
+		ignored_files.add(relpath)
+
+
+def walk_mission():
+	# like os.walk, but the size and mtime of the files are taken from the
+	# directory entries, which avoids a stat per file on windows
+	pending = [""]
+	while pending:
+		reldir = pending.pop()
+		root = os.path.join(mission.path, reldir) if reldir else mission.path
+		files, subdirs = [], []
+		try:
+			entries = list(os.scandir(root))
+		except OSError:
+			continue
+		for entry in entries:
+			try:
+				if entry.is_dir():
+					# like os.walk, links to dirs are neither walked nor files
+					if not entry.is_symlink():
+						subdirs.append(os.path.join(reldir, entry.name) if reldir else entry.name)
+					continue
+				st = entry.stat()
+				files.append((entry.name, st.st_size, st.st_mtime))
+			except OSError:
+				files.append((entry.name, 0, 0.0))  # broken links and such
+		yield root, reldir, files
+		pending.extend(reversed(subdirs))  # depth-first, in the same order as os.walk
 
-	add_ignored_maps()
 
-	for root, dirs, files in os.walk(mission.path):
-		included_folder = False
-		if should_ignore(root, ignored_folders):
-			num_exc_dirs += 1
-		else:
-			included_folder = True
-			num_inc_dirs += 1
+def create_file_groups():
+	mission.included = FileGroup(mission.path)
+	mission.excluded = FileGroup(mission.path)
+	# the mission dir itself isn't counted
+	mission.included.dir_count = mission.excluded.dir_count = -1
 
-		for file in files:
-			fullpath = os.path.join(root, file)
-			relpath = fullpath.replace(mission.path, '')[1:]
-			if included_folder and not should_ignore(relpath, ignored_files):
-				inc.append( MissionFile(fullpath, relpath) )
-				num_inc_files += 1
-			else:
-				exc.append( MissionFile(fullpath, relpath) )
-				num_exc_files += 1
 
-	mission.included = FileGroup(inc, num_inc_dirs, num_inc_files)
-	mission.excluded = FileGroup(exc, num_exc_dirs, num_exc_files)
+def gather_files():
+	create_file_groups()
+	add_ignored_maps()
+	add_ignored_pack_log()
+
+	for _ in walk_included_files(): pass
 
 	# print("\nincluded files")
 	# for f in inc:
@@ -285,14 +615,111 @@ def gather_files():
 	# print(f"\n       total {num_inc_dirs+num_exc_dirs} dirs, {num_inc_files+num_exc_files} files  | {len(inc)+len(exc)}" )
 
 
+def walk_included_files():
+	# sorts the files into 'mission.included' and 'mission.excluded', and
+	# yields the index of each included file as soon as it's found
+	inc = mission.included
+	exc = mission.excluded
+
+	for root, reldir, files in walk_mission():
+		included_folder = False
+		if should_ignore(root, ignored_folders):
+			exc.dir_count += 1
+		else:
+			included_folder = True
+			inc.dir_count += 1
+
+		inc_dir_id = exc_dir_id = None
+		for name, size, mtime in files:
+			relpath = os.path.join(reldir, name) if reldir else name
+			if included_folder and not should_ignore(relpath, ignored_files):
+				if inc_dir_id is None: inc_dir_id = inc.add_dir(reldir)
+				inc.add_file(inc_dir_id, name, size, mtime)
+				yield inc.file_count - 1
+			else:
+				if exc_dir_id is None: exc_dir_id = exc.add_dir(reldir)
+				exc.add_file(exc_dir_id, name, size, mtime)
+
+
+def stream_included_files():
+	# the walk runs on its own thread and feeds the packer through a bounded
+	# queue, so listing the directories overlaps with reading and compressing
+	create_file_groups()
+	add_ignored_maps()
+	add_ignored_pack_log()
+
+	found = queue.Queue(maxsize=PACK_QUEUE_SIZE)
+	stop = threading.Event()
+	failure = []
+
+	def walk():
+		try:
+			for i in walk_included_files():
+				if stop.is_set(): break
+				found.put(i)
+		except BaseException as e:
+			failure.append(e)
+		finally:
+			found.put(None)
+
+	walker = threading.Thread(target=walk, daemon=True)
+	walker.start()
+
+	def consume():
+		try:
+			while True:
+				i = found.get()
+				if i is None: break
+				yield MissionFile(mission.included, i)
+		finally:
+			# if packing failed, unblock the walker so it can finish
+			stop.set()
+			while walker.is_alive():
+				try: found.get_nowait()
+				except queue.Empty: walker.join(0.01)
+		if failure: raise failure[0]
+
+	return consume()
+
+
+def can_stream_pack():
+	# anything else needs the whole list of files before it starts
+	return not (args.deterministic or args.base or args.check
+		or args.where or args.diff or args.near or args.changes
+		or args.verify is not None or args.list_included or args.list_excluded
+		or args.strip_unused)
+
+
 
 def parse_maps():
 	if args.verbose: echo("Parsing maps")
 
-	for map in mission.map_names:
-		filepath = os.path.join(mission.path, "maps", map + ".map")
+	for map_name in mission.map_names:
+		filepath = os.path.join(mission.path, "maps", map_name + ".map")
 		map_parser.parse(filepath)
 
+		map = map_parser.maps[-1]
+		map.name = map_name
+		cache = load_entity_cache(map_name)
+		map.prev_hashes = cache.get("hashes", {})
+		cache["hashes"] = map.get_entity_hashes()
+		save_entity_cache(map_name, cache)
+
+
+def load_entity_cache(map_name):
+	return load_json_cache(get_mission_cache_path(f"entities_{map_name}.json")) or {}
+
+
+def save_entity_cache(map_name, cache):
+	save_json_cache(get_mission_cache_path(f"entities_{map_name}.json"), cache)
+
+
+def diff_entity_hashes(old, new):
+	added   = sorted(k for k in new if not k in old)
+	removed = sorted(k for k in old if not k in new)
+	changed = sorted(k for k in new if k in old and old[k] != new[k])
+	return added, removed, changed
+
 
 def get_included_files_in_dir(dirname, filters=[]):
 	dir_relpath = os.path.join(mission.name, dirname)
@@ -389,6 +816,38 @@ def parse_def_files(dirname, file_filters, match_pattern=None, include_prefixes=
 	return defs
 
 
+def find_redundant_files():
+	candidates = {}
+	for f in mission.included.files:
+		key = get_arcname(f.relpath).lower()
+		if key in base.files and f.size == base.files[key][0]:
+			candidates[f.fullpath] = f.relpath
+
+	crcs = get_crc32_of_files(list(candidates))
+	return sorted( get_arcname(relpath)
+		for fullpath, relpath in candidates.items()
+			if crcs[fullpath] == base.files[get_arcname(relpath).lower()][1])
+
+
+def read_text_file(path):
+	# latin-1 maps every byte to a char, so the text always round-trips
+	with open(path, 'r', encoding="latin-1", newline='') as f:
+		return f.read()
+
+
+def get_mission_decl_names():
+	decls = {}
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		ext = os.path.splitext(arcname)[1].lower()
+		if not ext in DECL_KINDS: continue
+		if not arcname.split('/')[0] in DECL_DIRS[ext]: continue
+		for kind, names in get_decl_names(read_text_file(f.fullpath), ext).items():
+			if not kind in decls: decls[kind] = set()
+			decls[kind].update(n.lower() for n in names)
+	return decls
+
+
 def report_unused_definitions(name, unused):
 	file_count = 0
 	item_count = 0
@@ -471,22 +930,683 @@ def print_quick_help():
 	""")
 
 
-def pack_fm():
+def pack_fm(stream=False):
 	zipname = mission.name + ".pk4"
 
+	if base.files:
+		for name in find_redundant_files():
+			warning(f"'{name}' is identical to a stock asset")
+
+	if args.strip_unused:
+		mission.unused_decls = get_unused_decl_spans()
+		report_unused_decl_spans()
+
+	# when streaming, the files are packed while they're still being found
+	files = stream_included_files() if stream else mission.included.files
+
+	check_compiled_maps()
+
+	manifest = None
+	if args.deterministic:
+		files = sorted(files, key=lambda file: get_arcname(file.relpath))
+		manifest = create_manifest(files)
+		if is_pk4_up_to_date(zipname, manifest):
+			echo(f"\n'{zipname}' is up to date, nothing changed since it was packed.")
+			return
+
 	echo(f"\nPacking '{zipname}'... \n")
 	t1 = time.time()
 
+	if stream:
+		progress = ProgressReporter(None, None)  # the totals aren't known yet
+	else:
+		total_bytes = sum(mission.included.sizes)
+		progress = ProgressReporter(mission.included.file_count, total_bytes)
+	pack_log = open(args.pack_log, 'w', buffering=1024*1024) if args.pack_log else None
+	release_stats = {}  # { extension : [files, level 9 size, packed size] }
+	minify_stats  = []  # (saved bytes, source size, relpath)
+
 	with zipf.ZipFile(zipname, 'w', zipf.ZIP_DEFLATED, compresslevel=9) as f:
-		for file in mission.included.files:
-			echo("    ", file.relpath)
-			f.write(file.relpath)
+		entries = compress_for_release(files) if args.release else ( (file, None) for file in files )
+		for file, compressed in entries:
+			if args.verbose: echo("    ", file.relpath)
+			if compressed:
+				info = write_release_entry(f, file, *compressed)
+				stats = release_stats.setdefault(os.path.splitext(file.relpath)[1].lower(), [0, 0, 0])
+				stats[0] += 1
+				stats[1] += compressed[2]
+				stats[2] += info.compress_size
+			else:
+				info = write_pack_entry(f, file)
+			if info.file_size != file.size:
+				minify_stats.append( (file.size - info.file_size, file.size, file.relpath) )
+			progress.update(info.file_size, info.compress_size)
+			if pack_log:
+				pack_log.write(f"{info.filename}\t{info.file_size}\t{info.compress_size}\n")
+
+	if pack_log: pack_log.close()
+	progress.finish()
+
+	if manifest:
+		with open(zipname + MANIFEST_EXT, 'w', newline='\n') as mf:
+			mf.write(manifest + get_pk4_stamp(zipname))
 
 	t2 = time.time()
 	total_time = "{:.1f}".format(t2-t1)
 
 	echo(f"\nPacking '{zipname}' completed with {mission.warning_count} warnings.")
 	echo(f"    {mission.included.dir_count} dirs, {mission.included.file_count} files, {total_time} seconds")
+	echo(f"    {progress.bytes_in/MEGABYTE:.1f} MB in, {progress.bytes_out/MEGABYTE:.1f} MB out")
+
+	if args.minify or args.strip_unused:
+		report_minify_savings(minify_stats)
+	if release_stats:
+		report_release_savings(release_stats)
+
+
+def get_compiled_map_files(map_name):
+	# { arcname : mtime } of the map's dmap output
+	files = {}
+	maps_dir = os.path.join(mission.path, "maps")
+	for entry in os.scandir(maps_dir):
+		root, ext = os.path.splitext(entry.name)
+		if root != map_name or not entry.is_file(): continue
+		if any(ext.lower().startswith(e) for e in COMPILED_MAP_EXTENSIONS):
+			files[f"maps/{entry.name}"] = entry.stat().st_mtime
+	return files
+
+
+def get_map_fingerprint(map_name, map_path):
+	# the hash of every entity, which includes their brushes and patches
+	for map in map_parser.maps:
+		if map.name == map_name: break  # already parsed for the checks
+	else:
+		parser = MapParser()
+		parser.parse(map_path)
+		map = parser.maps[-1]
+
+	h = hashlib.blake2b(digest_size=16)
+	for key, value in sorted(map.get_entity_hashes().items()):
+		h.update(f"{key}\t{value}\n".encode())
+	return h.hexdigest()
+
+
+def check_compiled_maps():
+	# The fingerprint of a map is only computed again when its size or mtime
+	# change. If the map is newer than its compiled files, but its fingerprint
+	# is the same as when they were compiled, it was only saved again
+	cache_path = get_mission_cache_path("compiled.json")
+	cache = load_json_cache(cache_path) or {}
+	new_cache = {}
+
+	for map_name in mission.map_names:
+		map_path = os.path.join(mission.path, "maps", map_name + ".map")
+		if not os.path.isfile(map_path): continue
+		st = os.stat(map_path)
+		stamp = [st.st_size, st.st_mtime]
+
+		entry = cache.get(map_name, {})
+		if entry.get("map") == stamp:
+			fingerprint = entry["fingerprint"]
+		else:
+			try:
+				fingerprint = get_map_fingerprint(map_name, map_path)
+			except (OSError, AssertionError, LookupError, ValueError):
+				warning(f"'maps/{map_name}.map' could not be parsed, it's checked by its modification time only")
+				fingerprint = None
+
+		compiled = get_compiled_map_files(map_name)
+		stale = sorted(name for name, mtime in compiled.items() if mtime < st.st_mtime)
+		if stale and fingerprint and entry.get("compiled") == fingerprint and entry.get("artifacts") == compiled:
+			stale = []
+
+		if fingerprint is None:
+			# the old entry is kept, and the map is parsed again next time
+			if entry: new_cache[map_name] = entry
+		else:
+			new_entry = { "map": stamp, "fingerprint": fingerprint }
+			if compiled and not stale:
+				new_entry["compiled"]  = fingerprint
+				new_entry["artifacts"] = compiled
+			elif "compiled" in entry:
+				new_entry["compiled"]  = entry["compiled"]
+				new_entry["artifacts"] = entry["artifacts"]
+			new_cache[map_name] = new_entry
+
+		if stale:
+			names = ", ".join(os.path.basename(name) for name in stale)
+			warning(f"'maps/{map_name}.map' changed since it was compiled ({names} are older), run dmap again")
+
+	if new_cache != cache:
+		save_json_cache(cache_path, new_cache)
+
+
+def write_pack_entry(f, file):
+	if not (args.deterministic or is_rewritten(file)):
+		f.write(file.relpath)
+		return f.filelist[-1]
+
+	info = get_deterministic_info(file) if args.deterministic else zipf.ZipInfo.from_file(file.relpath)
+	f.writestr(info, read_pack_data(file), zipf.ZIP_DEFLATED, 9)
+	return info
+
+
+def is_minified(file):
+	return args.minify and os.path.splitext(file.relpath)[1].lower() in MINIFY_EXTENSIONS
+
+
+def is_rewritten(file):
+	return is_minified(file) or file.fullpath in mission.unused_decls
+
+
+def read_pack_data(file):
+	# the bytes that go into the pk4 for a file, the source files are never changed
+	if not is_rewritten(file):
+		with open(file.fullpath, 'rb') as src:
+			return src.read()
+
+	text = read_text_file(file.fullpath)
+	if file.fullpath in mission.unused_decls:
+		text = remove_decl_spans(text, mission.unused_decls[file.fullpath])
+	if is_minified(file):
+		text = minify_decl_text(text)
+	return text.encode("latin-1")
+
+
+def minify_decl_text(text):
+	# drops comments, indentation, blank lines and the spaces around braces
+	# and other punctuation. The line breaks between tokens are kept, since
+	# some of the engine's parsers read tokens up to the end of a line, and
+	# '#' directives are copied as they are
+	out = []
+	line_start = True
+	prev = None
+	skip_to = 0
+	for token, pos in tokenize_decl(text):
+		if pos < skip_to: continue
+		if prev is not None:
+			gap = text[prev_end:pos]
+			if '\n' in gap:
+				out.append('\n')
+				line_start = True
+			elif gap and not (prev in MINIFY_PUNCTUATION or token in MINIFY_PUNCTUATION):
+				out.append(' ')
+
+		end = pos + len(token)
+		if token.startswith('#') and line_start:
+			# a directive, e.g. '#include' or '#define', up to the end of the line
+			# (and of any lines continued with '\'), where whitespace can matter
+			while True:
+				end = text.find('\n', end)
+				if end < 0:
+					end = len(text)
+					break
+				if not text[pos:end].rstrip().endswith('\\'): break
+				end += 1
+			token = text[pos:end].rstrip()
+			skip_to = end
+
+		out.append(token)
+		line_start = False
+		prev = token
+		prev_end = end
+	if out: out.append('\n')
+	return "".join(out)
+
+
+def report_minify_savings(minify_stats):
+	if not minify_stats: return
+	echo("\n  Text files made smaller when packing:\n")
+	minify_stats.sort(reverse=True)
+	shown = minify_stats if args.verbose else minify_stats[:MINIFY_TOP_COUNT]
+	for saved, size, relpath in shown:
+		echo(f"    {format_size_delta(-saved):>12}  ({saved*100/max(size, 1):4.1f}%)  {relpath}")
+	if len(shown) < len(minify_stats):
+		echo(f"    ... and {len(minify_stats) - len(shown)} more (use -v to list all)")
+	saved = sum(item[0] for item in minify_stats)
+	size = sum(item[1] for item in minify_stats)
+	echo(f"    {format_size_delta(-saved):>12}  ({saved*100/max(size, 1):4.1f}%)  in {len(minify_stats)} files")
+
+
+def get_deterministic_info(file):
+	# the same content always gives the same bytes: no timestamps, no
+	# permissions or host system from the machine that packed it
+	info = zipf.ZipInfo(get_arcname(file.relpath), date_time=DETERMINISTIC_DATE_TIME)
+	info.external_attr = DETERMINISTIC_FILE_ATTR
+	info.create_system = 3
+	return info
+
+
+def deflate(data, mem_level, strategy):
+	compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level, strategy)
+	return compressor.compress(data) + compressor.flush()
+
+
+def normalize_decl_ref(ref):
+	return ref.replace('\\', '/').lower()
+
+
+def get_used_decl_refs():
+	# everything that can name a decl: map entities and brushes, the
+	# materials in the models, guis, scripts and the mission's own defs
+	if not map_parser.maps: parse_maps()
+
+	refs = set(VALID_UNUSED_MATERIALS + IMPLICIT_MATERIALS)
+	for map_name in mission.map_names:
+		refs.add(f"maps/{map_name}/mission_briefing")
+
+	resolver = load_entity_defs()
+	for map in map_parser.maps:
+		for e in map.entities:
+			refs.update(e.materials)
+			refs.update(resolver.get_effective_properties(e).values())
+
+	refs.update(get_gui_script_references())
+
+	for path in get_included_files_in_dir("def", ["*.def"]):
+		for d in parse_decls(read_text_file(os.path.join(mission.path, path))):
+			refs.update(d.body)
+
+	# the models can come from the entityDefs as well as from the map
+	infos = get_used_model_infos(refs)
+	for info in infos.values():
+		refs.update(info.materials)
+
+	# models of the mission whose materials can't be read, because of
+	# their format or because they're corrupt
+	model_files = set( get_arcname(f.relpath).lower() for f in mission.included.files
+		if os.path.splitext(f.relpath)[1].lower() in MODEL_EXTENSIONS )
+	unscanned = set( normalize_decl_ref(ref) for ref in refs ) & model_files
+	unscanned -= set( arcname.lower() for arcname in infos )
+
+	used = set()
+	for ref in refs:
+		ref = normalize_decl_ref(ref)
+		used.add(ref)
+		if ref.endswith(".prt"): used.add(ref[:-4])  # particles are used as models
+	return used, unscanned
+
+
+def get_unused_decl_spans():
+	targets = []  # (fullpath, decl, always kept)
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		ext = os.path.splitext(arcname)[1].lower()
+		if not ext in STRIP_DECL_EXTENSIONS: continue
+		forced = arcname in VALID_UNUSED_XDATA_FILES
+		for d in parse_decls(read_text_file(f.fullpath)):
+			if d.type in DECL_KINDS[ext]:  # others, like tables, are always kept
+				targets.append((f.fullpath, d, forced))
+	if not targets: return {}
+
+	# the names in a kept decl are used too, e.g. the materials of a skin,
+	# so this is repeated until no more decls are kept. The decls in the
+	# allow-listed files are always kept, but their bodies are followed too
+	used, unscanned = get_used_decl_refs()
+	if unscanned:
+		# any material could be in them, so none can be proven unused
+		echo(f"\nKeeping all the materials, the materials of {len(unscanned)} models can't be read:")
+		for name in sorted(unscanned):
+			echo( REPORT_OBJECT.format(name) )
+		targets = [ (fullpath, d, forced or fullpath.lower().endswith(".mtr"))
+			for fullpath, d, forced in targets ]
+	if base.decls:
+		# overrides of stock materials can be used by any stock asset
+		used.update(base.decls.get("material", ()))
+
+	kept = set()  # indices into 'targets'
+	changed = True
+	while changed:
+		changed = False
+		for i, (fullpath, d, forced) in enumerate(targets):
+			if i in kept or not (forced or normalize_decl_ref(d.name) in used): continue
+			kept.add(i)
+			used.update(normalize_decl_ref(token) for token in d.body)
+			changed = True
+
+	spans = {}
+	for i, (fullpath, d, forced) in enumerate(targets):
+		if not i in kept:
+			spans.setdefault(fullpath, []).append((d.start, d.end, d.name))
+	return spans
+
+
+def remove_decl_spans(text, spans):
+	parts = []
+	pos = 0
+	for start, end, name in spans:
+		parts.append(text[pos:start])
+		pos = end
+		while pos < len(text) and text[pos] in " \t": pos += 1
+		if text.startswith("\r\n", pos): pos += 2
+		elif text.startswith("\n", pos): pos += 1
+	parts.append(text[pos:])
+	return "".join(parts)
+
+
+def report_unused_decl_spans():
+	count = sum(len(spans) for spans in mission.unused_decls.values())
+	echo(f"\nLeaving out {count} unused declarations from {len(mission.unused_decls)} files")
+	if not args.verbose: return
+	for fullpath, spans in sorted(mission.unused_decls.items()):
+		echo( REPORT_FILE.format(get_arcname(os.path.relpath(fullpath, mission.path))) )
+		for start, end, name in spans:
+			echo( REPORT_OBJECT.format(name) )
+
+
+def get_smallest_deflate(file):
+	# runs on a worker thread, zlib releases the GIL while compressing
+	data = read_pack_data(file)
+
+	streams = [ deflate(data, mem_level, strategy) for mem_level, strategy in RELEASE_DEFLATE_PARAMS ]
+	baseline = streams[0]
+	best = min(streams, key=len)
+	if best is not baseline and zlib.decompress(best, -zlib.MAX_WBITS) != data:
+		best = baseline
+	if len(best) >= len(data):
+		best = None  # stored as is
+	return data, best, len(baseline)
+
+
+def compress_for_release(files):
+	# yields (file, (data, stream, baseline size)) in the same order as
+	# 'files', with a bounded number of files being compressed at once
+	workers = get_worker_count()
+	pending = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for file in files:
+			pending.append( (file, executor.submit(get_smallest_deflate, file)) )
+			if len(pending) > workers * 2:
+				file, future = pending.pop(0)
+				yield file, future.result()
+		for file, future in pending:
+			yield file, future.result()
+
+
+class PrecompressedStream:
+	# stands in for the compressor of a zip entry being written, to
+	# write a stream that was already compressed
+	def __init__(self, stream):
+		self.stream = stream
+
+	def compress(self, data):
+		return b""
+
+	def flush(self):
+		return self.stream
+
+
+def write_release_entry(f, file, data, stream, baseline_size):
+	if args.deterministic:
+		info = get_deterministic_info(file)
+	else:
+		info = zipf.ZipInfo.from_file(file.relpath)
+
+	if stream is None:
+		f.writestr(info, data, zipf.ZIP_STORED)
+		return info
+
+	if not hasattr(zipf, "_ZipWriteFile"):
+		# zipfile internals changed, fall back to its own compression
+		f.writestr(info, data, zipf.ZIP_DEFLATED, 9)
+		return info
+
+	info.compress_type = zipf.ZIP_DEFLATED
+	info.file_size = len(data)
+	with f.open(info, 'w') as dest:
+		if hasattr(dest, "_compressor"):
+			dest._compressor = PrecompressedStream(stream)
+		dest.write(data)  # the CRC and sizes are still computed by zipfile
+	return info
+
+
+def report_release_savings(release_stats):
+	echo("\n  Release compression, compared with level 9:\n")
+	total_before = total_after = 0
+	rows = sorted(release_stats.items(), key=lambda item: item[1][2] - item[1][1])
+	for ext, (count, before, after) in rows:
+		total_before += before
+		total_after += after
+		echo(f"    {ext or '(none)':<10} {count:>6} files  {before/1024:>10.1f} KB -> {after/1024:>10.1f} KB"
+			f"  {format_size_delta(after - before):>12}")
+	count = sum(stats[0] for stats in release_stats.values())
+	echo(f"    {'total':<10} {count:>6} files  {total_before/1024:>10.1f} KB -> {total_after/1024:>10.1f} KB"
+		f"  {format_size_delta(total_after - total_before):>12}")
+
+
+def get_pack_options():
+	# anything that changes the packed bytes must be listed here
+	options = ["deterministic"]
+	if args.release: options.append("release")
+	if args.minify:  options.append("minify")
+	if args.strip_unused: options.append("strip_unused")
+	options.append(f"fmpak {VERSION}")
+	return options
+
+
+def create_manifest(files):
+	hashes = hash_files(get_file_sha256, [file.fullpath for file in files])
+	lines = [ "# " + ", ".join(get_pack_options()) ]
+	for file in files:
+		lines.append(f"{hashes[file.fullpath]}  {file.size:>10}  {get_arcname(file.relpath)}")
+	return "\n".join(lines) + "\n"
+
+
+def get_pk4_stamp(zipname):
+	# the last line of the manifest, which ties it to the pk4 it was written for
+	return f"# pk4 {get_file_sha256(zipname)} {os.path.getsize(zipname)}\n"
+
+
+def is_pk4_up_to_date(zipname, manifest):
+	manifest_path = zipname + MANIFEST_EXT
+	if not os.path.isfile(zipname) or not os.path.isfile(manifest_path):
+		return False
+	with open(manifest_path, 'r', newline='') as mf:
+		text = mf.read()
+	if not text.startswith(manifest): return False
+
+	# the pk4 could have been packed again since, without '--deterministic'
+	stamp = text[len(manifest):]
+	parts = stamp.split()
+	if len(parts) != 4 or parts[3] != str(os.path.getsize(zipname)):
+		return False
+	return stamp == get_pk4_stamp(zipname)
+
+
+class ProgressReporter:
+	def __init__(self, total_files, total_bytes):
+		self.total_files = total_files
+		self.total_bytes = total_bytes
+		self.files     = 0
+		self.bytes_in  = 0
+		self.bytes_out = 0
+		self.enabled   = not (args.quiet or args.verbose)
+		self.is_tty    = sys.stdout.isatty()
+		self.interval  = PROGRESS_INTERVAL if self.is_tty else PROGRESS_LOG_INTERVAL
+		self.t_start   = time.time()
+		self.t_last    = self.t_start
+		self.line_len  = 0
+
+	def update(self, bytes_in, bytes_out):
+		self.files     += 1
+		self.bytes_in  += bytes_in
+		self.bytes_out += bytes_out
+		if not self.enabled: return
+
+		t = time.time()
+		if t - self.t_last >= self.interval:
+			self.t_last = t
+			self.show(t)
+
+	def show(self, t):
+		elapsed = max(t - self.t_start, 0.001)
+		rate = self.bytes_in / elapsed
+		eta = "?"
+		if self.total_bytes and rate > 0:
+			eta = "{:.0f}s".format((self.total_bytes - self.bytes_in) / rate)
+
+		files = f"{self.files}/{self.total_files}" if self.total_files is not None else self.files
+		line = f"    {files} files, " \
+			f"{self.bytes_in/MEGABYTE:.1f} MB in, {self.bytes_out/MEGABYTE:.1f} MB out, " \
+			f"{rate/MEGABYTE:.1f} MB/s, ETA {eta}"
+
+		if self.is_tty:
+			# pad to clear what's left of a longer previous line
+			echo('\r' + line.ljust(self.line_len), end="", flush=True)
+			self.line_len = len(line)
+		else:
+			echo(line)
+
+	def finish(self):
+		if not self.enabled: return
+		self.show(time.time())
+		if self.is_tty: echo()
+
+
+def verify_pk4(pk4_path):
+	task(f"Verifying '{pk4_path}'... ")
+
+	if not os.path.isfile(pk4_path):
+		error(f"no pk4 found at '{pk4_path}'")
+
+	index = read_pk4_index(pk4_path)
+	missing, mismatched, extra, current = compare_with_pk4(index)
+
+	if not (missing or mismatched or extra):
+		echo(REPORT_OK)
+		echo(f"    {len(index)} entries match the source files")
+		return True
+
+	if missing:
+		echo("\n\n  Some files are missing from the pk4\n")
+		for name in missing:
+			echo( REPORT_OBJECT.format(name) )
+		echo( REPORT_COUNT.format(len(missing), "missing files") )
+
+	if mismatched:
+		echo("\n\n  Some pk4 entries differ from the source files\n")
+		for name in mismatched:
+			echo( REPORT_OBJECT.format(name) )
+		echo( REPORT_COUNT.format(len(mismatched), "mismatched files") )
+
+	if extra:
+		echo("\n\n  Some pk4 entries are not in the included files\n")
+		for name in extra:
+			echo( REPORT_OBJECT.format(name) )
+		echo( REPORT_COUNT.format(len(extra), "extra entries") )
+
+	return False
+
+
+def report_references(query):
+	task(f"Looking up references to '{query}'... ")
+
+	found = find_references(query)
+	if not found:
+		echo("no references found")
+		return
+
+	echo()
+	num_refs = 0
+	for name, locations in found.items():
+		echo(f"\n    {name}")
+		for loc in locations:
+			num_refs += 1
+			kind = loc[0]
+			if   kind == "map":   echo(f"        map '{loc[1]}': {loc[2]} ({loc[3]}), {loc[4]}")
+			elif kind == "decl":  echo(f"        {loc[1]}: {loc[2]}")
+			elif kind == "model": echo(f"        model {loc[1]}")
+			else:                 echo(f"        {loc[1]}")
+	echo(f"\n  {num_refs} references to {len(found)} names\n")
+
+
+def compare_with_pk4(index):
+	# compares the included files with a pk4's index from read_pk4_index.
+	# Returns the sorted names of the files missing from the pk4, the ones
+	# that differ and the pk4 entries with no file, and { name : (file, size) }
+	# with the size the file has in the pk4
+	if args.strip_unused:
+		mission.unused_decls = get_unused_decl_spans()
+
+	current    = {}
+	missing    = []
+	mismatched = []
+	to_check   = {}
+	for f in mission.included.files:
+		name = get_arcname(f.relpath)
+		# minified or stripped files are compared with what would be packed
+		data = read_pack_data(f) if is_rewritten(f) else None
+		size = f.size if data is None else len(data)
+		current[name] = (f, size)
+		if not name in index:
+			missing.append(name)
+		elif size != index[name][0]:
+			mismatched.append(name)
+		elif data is not None:
+			if zlib.crc32(data) != index[name][1]:
+				mismatched.append(name)
+		else:
+			to_check[f.fullpath] = name
+
+	# the CRCs are only needed when the sizes are the same
+	crcs = get_crc32_of_files(list(to_check))
+	for fullpath, name in to_check.items():
+		if crcs[fullpath] != index[name][1]:
+			mismatched.append(name)
+
+	extra = sorted(n for n in index if not n in current)
+	return sorted(missing), sorted(mismatched), extra, current
+
+
+def format_size_delta(delta):
+	sign = '+' if delta >= 0 else '-'
+	if abs(delta) < 1024: return f"{sign}{abs(delta)} B"
+	return f"{sign}{abs(delta)/1024:.1f} KB"
+
+
+def report_pk4_diff(old_pk4_path):
+	task(f"Comparing with '{old_pk4_path}'... ")
+
+	if not os.path.isfile(old_pk4_path):
+		error(f"no pk4 found at '{old_pk4_path}'")
+
+	index = read_pk4_index(old_pk4_path)
+	added, modified, removed, current = compare_with_pk4(index)
+	if not (added or modified or removed):
+		echo("no changes")
+		return
+
+	echo()
+	total_delta = 0
+	if added:
+		echo("\n    added:")
+		for name in added:
+			delta = current[name][1]
+			total_delta += delta
+			echo(f"        {format_size_delta(delta):>12}  {name}")
+	if modified:
+		echo("\n    modified:")
+		for name in modified:
+			delta = current[name][1] - index[name][0]
+			total_delta += delta
+			echo(f"        {format_size_delta(delta):>12}  {name}")
+	if removed:
+		echo("\n    removed:")
+		for name in removed:
+			delta = -index[name][0]
+			total_delta += delta
+			echo(f"        {format_size_delta(delta):>12}  {name}")
+
+	echo(f"\n  {len(added)} added, {len(modified)} modified, {len(removed)} removed, "
+		f"{format_size_delta(total_delta)} uncompressed\n")
+
+	if args.diff_out:
+		changed = [ current[name][0] for name in sorted(added + modified) ]
+		task(f"Writing the {len(changed)} changed files to '{args.diff_out}'... ")
+		with zipf.ZipFile(args.diff_out, 'w', zipf.ZIP_DEFLATED, compresslevel=9) as f:
+			for file in changed:
+				write_pack_entry(f, file)
+		echo("done")
 
 
 def check_files(arg, file_group, header):
@@ -511,6 +1631,106 @@ def check_files(arg, file_group, header):
 	else:       echo(f"\n       {num_files}/{file_group.file_count} files")
 
 
+def run_checks():
+	if args.check in ["all"] + VALIDATION_PARAMS:
+		validate_mission_files()
+	else:
+		check_entity_properties()
+
+
+def get_mission_paths(paths):
+	# a directory without a darkmod.txt is taken as a parent of missions
+	mission_paths = []
+	for p in paths:
+		path = parse_path(p)
+		if os.path.isdir(path) and not os.path.isfile(os.path.join(path, MODFILE_FILENAME)):
+			sub_paths = [ os.path.join(p, d)
+				for d in sorted(os.listdir(path))
+					if os.path.isfile(os.path.join(path, d, MODFILE_FILENAME))]
+			if sub_paths:
+				mission_paths += sub_paths
+				continue
+		mission_paths.append(p)
+	return mission_paths
+
+
+def run_mission(path, options):
+	# runs in a worker process, where the globals from '__main__' don't exist
+	global args, map_parser
+	args = options
+	map_parser = MapParser()
+	reset_mission()
+
+	failed = False
+	out = io.StringIO()
+	cwd = os.getcwd()
+	t1 = time.time()
+
+	with redirect_stdout(out):
+		try:
+			set_fm_path(path)
+			validate_fm_path()
+			os.chdir(mission.path)
+			if args.pack_log:
+				# one log per mission, they'd overwrite each other otherwise
+				root, ext = os.path.splitext(args.pack_log)
+				args.pack_log = f"{root}_{mission.name}{ext}"
+			load_pkignore()
+			if can_stream_pack():
+				pack_fm(stream=True)
+			else:
+				gather_files()
+				if args.base:
+					load_base_index(args.base)
+				if args.check:
+					run_checks()
+				pack_fm()
+		except SystemExit:
+			failed = True
+		except Exception:
+			failed = True
+			echo(traceback.format_exc())
+		finally:
+			os.chdir(cwd)  # workers are reused, and the paths may be relative
+
+	t2 = time.time()
+	file_count = mission.included.file_count if not failed else 0
+	return os.path.basename(path), failed, mission.warning_count, file_count, t2-t1, out.getvalue()
+
+
+def pack_batch(paths):
+	echo(f"Packing {len(paths)} missions... \n")
+	t1 = time.time()
+
+	if args.base:
+		# indexed once here, so the workers only read the cache
+		load_base_index(args.base)
+
+	results = []
+	with ProcessPoolExecutor(max_workers=min(get_worker_count(), len(paths))) as executor:
+		for res in executor.map(run_mission, paths, [args] * len(paths)):
+			name, failed, warning_count, file_count, secs, log = res
+			if failed or warning_count or args.verbose or args.check:
+				echo(f"  ---- {name} ----")
+				echo(log)
+			results.append(res)
+
+	t2 = time.time()
+	total_time = "{:.1f}".format(t2-t1)
+
+	num_failed = 0
+	echo(f"\n  Summary\n")
+	for name, failed, warning_count, file_count, secs, log in results:
+		if failed:
+			num_failed += 1
+			echo(f"    FAILED  {name:<30}")
+		else:
+			echo(f"    ok      {name:<30} {file_count} files, {warning_count} warnings, {secs:.1f} seconds")
+
+	echo(f"\n  {len(results)-num_failed}/{len(results)} missions packed, {total_time} seconds\n")
+	return num_failed == 0
+
+
 def get_pkignore_csv():
 	file_path = os.path.join(mission.path, PKIGNORE_FILENAME)
 	if not os.path.exists(file_path):
@@ -582,6 +1802,132 @@ def validate_filepaths():
 		echo(REPORT_OK)
 
 
+def get_gui_script_references():
+	# results are cached by file mtime, since gui and script files are rarely touched
+	cache_path = get_mission_cache_path("references.json")
+	cache = load_json_cache(cache_path) or {}
+
+	new_cache = {}
+	refs = set()
+	for f in mission.included.files:
+		ext = os.path.splitext(f.relpath)[1].lower()
+		if not ext in [".gui", ".script"]: continue
+
+		arcname = get_arcname(f.relpath)
+		mtime = f.mtime
+		entry = cache.get(arcname)
+		if not entry or entry[0] != mtime:
+			text = read_text_file(f.fullpath)
+			file_refs = get_gui_references(text) if ext == ".gui" else get_script_references(text)
+			entry = [mtime, sorted(file_refs)]
+		new_cache[arcname] = entry
+		refs.update(entry[1])
+
+	if new_cache != cache:
+		save_json_cache(cache_path, new_cache)
+	return refs
+
+
+_number_re = re.compile(r'^[-+\d.eE\s]*$')
+
+
+def add_reference(index, name, location):
+	if not name or _number_re.match(name): return
+	index.setdefault(name.lower(), []).append(location)
+
+
+def get_where_fingerprint():
+	# everything the index is built from, with sizes and mtimes
+	h = hashlib.blake2b(digest_size=16)
+	map_files = set(f"maps/{name}.map" for name in mission.map_names)
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		ext = os.path.splitext(arcname)[1].lower()
+		if arcname in map_files or ext in DECL_KINDS or ext in [".gui", ".script"] + SCANNED_MODEL_EXTENSIONS:
+			h.update(f"{arcname}|{f.size}|{f.mtime}\n".encode())
+	return h.hexdigest()
+
+
+def build_where_index():
+	index = {}
+
+	parse_maps()
+	for map in map_parser.maps:
+		for e in map.entities:
+			ent = [ "map", map.name, e.get_key(), e.classname ]
+			for prop, val in e.properties.items():
+				if prop in ["name", "origin", "rotation"]: continue
+				add_reference(index, val, ent + [prop])
+			for mat in e.materials:
+				if mat != e.properties.get("texture"):
+					add_reference(index, mat, ent + ["(brush/patch material)"])
+
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		ext = os.path.splitext(arcname)[1].lower()
+		if ext in DECL_KINDS and ext != ".xd":
+			for d in parse_decls(read_text_file(f.fullpath)):
+				decl = [ "decl", arcname, f"{d.type} {d.name}".strip() ]
+				if ext == ".def":  # key/value pairs, only the values are references
+					for i in range(1, len(d.body), 2):
+						add_reference(index, d.body[i], decl)
+				else:
+					for token in set(d.body):
+						if '/' in token: add_reference(index, token, decl)
+		elif ext in [".gui", ".script"]:
+			text = read_text_file(f.fullpath)
+			refs = get_gui_references(text) if ext == ".gui" else get_script_references(text)
+			for ref in refs:
+				add_reference(index, ref, [ "file", arcname ])
+
+	for arcname, info in get_used_model_infos().items():
+		for mat in info.materials:
+			add_reference(index, mat, [ "model", arcname ])
+
+	return index
+
+
+def load_where_index():
+	cache_path = get_mission_cache_path("where.json")
+	fingerprint = get_where_fingerprint()
+	cache = load_json_cache(cache_path)
+	if cache and cache.get("fingerprint") == fingerprint:
+		return cache["index"]
+
+	index = build_where_index()
+	save_json_cache(cache_path, { "fingerprint": fingerprint, "index": index })
+	return index
+
+
+def find_references(query):
+	index = load_where_index()
+	pattern = query.lower()
+	if any(c in pattern for c in "*?["):
+		names = sorted(n for n in index if fnmatch(n, pattern))
+	else:
+		names = [pattern] if pattern in index else []
+	return { name: index[name] for name in names }
+
+
+def get_used_model_infos(models=None):
+	# scans the mission's models that are used by the maps, or that are
+	# in 'models' if it's given
+	model_files = {}
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		if os.path.splitext(arcname)[1].lower() in SCANNED_MODEL_EXTENSIONS:
+			model_files[arcname.lower()] = (arcname, f.fullpath)
+
+	infos = {}
+	if models is None: models = get_property_values("model")
+	for model in set(models):
+		key = model.replace('\\', '/').lower()
+		if key in model_files and not key in infos:
+			arcname, fullpath = model_files[key]
+			infos[key] = (arcname, scan_model(fullpath))
+	return { arcname: info for arcname, info in infos.values() if info }
+
+
 def validate_models():
 	task("Checking models... ")
 
@@ -593,6 +1939,14 @@ def validate_models():
 
 	report_unused_files("model", unused)
 
+	if args.verbose:
+		infos = get_used_model_infos()
+		if infos:
+			echo("\n  Triangles in the models in use\n")
+			for arcname, info in sorted(infos.items(), key=lambda x: -x[1].triangles):
+				echo(f"        {info.triangles:>8}  {arcname}")
+			echo()
+
 
 def validate_materials():
 	if args.defs: task("Checking material definitions... ")
@@ -601,10 +1955,16 @@ def validate_materials():
 	files = parse_def_files("materials", ["*.mtr"])
 	if not check_any_found(files, "materials"): return
 
-	used = []
+	used = set()
 	for map in map_parser.maps:
 		for e in map.entities:
-			used += e.materials
+			used.update(e.materials)
+
+	# materials applied inside the models
+	for info in get_used_model_infos().values():
+		used.update(info.materials)
+
+	used.update(get_gui_script_references())
 
 	if args.defs:
 		unused = check_unused_defs_in(files, used, VALID_UNUSED_MATERIALS)
@@ -622,6 +1982,7 @@ def validate_skins():
 	if not check_any_found(files, "skins"):	return
 
 	used = get_property_values("skin")
+	used += get_gui_script_references()
 	if args.defs:
 		unused = check_unused_defs_in(files, used)
 		report_unused_definitions("skins", unused)
@@ -683,16 +2044,558 @@ def parse_entities():
 	return defs
 
 
+def validate_redundant_files():
+	task("Checking for copies of stock assets... ")
+
+	if not base.files:
+		echo(" skipped, the base game path must be given with '--base'.")
+		return
+
+	redundant = find_redundant_files()
+	if len(redundant) > 0:
+		echo("\n\n  Some files are identical to stock assets, and only add to the download size\n")
+		for name in redundant:
+			echo( REPORT_OBJECT.format(name) )
+		echo( REPORT_COUNT.format(len(redundant), "redundant files") )
+	else:
+		echo(REPORT_OK)
+
+
+def load_entity_defs():
+	# built once per mission, and shared by all the checks
+	if mission.entity_defs: return mission.entity_defs
+
+	# stock defs first (from the base index), so that the mission's own defs override them
+	defs = dict(base.defs) if base.defs else {}
+	for path in get_included_files_in_dir("def", ["*.def"]):
+		defs.update(parse_entity_defs(read_text_file(os.path.join(mission.path, path))))
+
+	mission.entity_defs = EntityDefResolver(defs)
+	return mission.entity_defs
+
+
+class AssetResolver:
+	def __init__(self):
+		self.files = set(get_arcname(f.relpath).lower() for f in mission.included.files)
+		self.decls = get_mission_decl_names()
+		if base.files:
+			self.files.update(base.files)
+			for kind, names in base.decls.items():
+				self.decls.setdefault(kind, set()).update(names)
+		self.implicit_materials = set(IMPLICIT_MATERIALS)
+
+	def has_decl(self, kind, name):
+		return name in self.decls.get(kind, ())
+
+	def has_image(self, name):
+		for ext in IMAGE_EXTENSIONS:
+			if name + ext in self.files: return True
+		return "dds/" + name + ".dds" in self.files
+
+	def has_material(self, name):
+		# materials without a declaration are created from an image with the same name
+		return name in self.implicit_materials \
+			or self.has_decl("material", name) \
+			or self.has_image(name)
+
+	def get_missing_references(self, e):
+		missing = []
+
+		classname = e.classname.lower()
+		if classname and not self.has_decl("entityDef", classname):
+			missing.append(("classname", e.classname))
+
+		model = e.properties.get("model", "").replace('\\', '/')
+		if model and model != e.name:  # brush models use the entity's own name
+			lmodel = model.lower()
+			ext = os.path.splitext(lmodel)[1]
+			if   ext == ".prt":             found = self.has_decl("particle", lmodel[:-4])
+			elif ext in MODEL_EXTENSIONS:   found = lmodel in self.files
+			else:                           found = self.has_decl("model", lmodel)
+			if not found:
+				missing.append(("model", model))
+
+		skin = e.properties.get("skin", "")
+		if skin and not self.has_decl("skin", skin.lower()):
+			missing.append(("skin", skin))
+
+		for mat in sorted(e.materials):
+			if not self.has_material(mat.lower()):
+				missing.append(("material", mat))
+
+		return missing
+
+
+def validate_missing_references():
+	task("Checking for missing references... ")
+
+	if not base.files:
+		echo(" skipped, the base game path must be given with '--base'.")
+		return
+
+	resolver = AssetResolver()
+	total = 0
+	reports = []
+	for i in range(len(map_parser.maps)):
+		ents = []
+		for e in map_parser.maps[i].entities:
+			missing = resolver.get_missing_references(e)
+			if missing:
+				ents.append((e, missing))
+				total += len(missing)
+		if ents:
+			reports.append((mission.map_names[i], ents))
+
+	if total > 0:
+		echo("\n\n  Some references were not found in the mission or the game\n")
+		for map_name, ents in reports:
+			echo( REPORT_MAP.format(map_name) )
+			for e, missing in ents:
+				ident = e.name if e.name else f"entity {e.id}"
+				echo(f"        {ident:<30} {e.classname}")
+				for kind, value in missing:
+					echo(f"            {kind:<10} {value}")
+		echo( REPORT_COUNT.format(total, "missing references") )
+	else:
+		echo(REPORT_OK)
+
+
+def get_budget_limits():
+	limits = dict(BUDGET_LIMITS)
+	if args.limits:
+		for param in args.limits.replace(', ', ',').split(','):
+			parts = param.split()
+			if len(parts) != 2 or not parts[0] in limits or not parts[1].isdigit():
+				error(f"invalid limit '{param}', use '<name> <number>' with names from {list(limits)}")
+			limits[parts[0]] = int(parts[1])
+	return limits
+
+
+def get_light_radius(props):
+	try:
+		return max(abs(float(v)) for v in props.get("light_radius", "").split())
+	except ValueError:
+		return 0.0  # no radius, or not a number
+
+
+def is_light(e, props):
+	return e.classname == "light" or props.get("spawnclass") == "idLight" or "light_radius" in props
+
+
+def get_map_budget(map, resolver):
+	stats = {
+		"entities"      : len(map.entities),
+		"brushes"       : 0,
+		"patches"       : 0,
+		"func_statics"  : 0,
+		"lights"        : 0,
+		"shadow_lights" : 0,
+		"big_lights"    : 0,
+	}
+	classnames = {}
+	materials  = {}
+	radii      = []
+
+	for e in map.entities:
+		stats["brushes"] += len(e.brushes)
+		stats["patches"] += len(e.patches)
+		classnames[e.classname] = classnames.get(e.classname, 0) + 1
+		if e.classname == "func_static":
+			stats["func_statics"] += 1
+
+		for b in e.brushes:
+			for mat in b.materials:
+				materials[mat] = materials.get(mat, 0) + 1
+		for p in e.patches:
+			materials[p.material] = materials.get(p.material, 0) + 1
+
+		props = resolver.get_effective_properties(e)
+		if is_light(e, props):
+			stats["lights"] += 1
+			if props.get("noshadows", "0") != "1":
+				stats["shadow_lights"] += 1
+			radius = get_light_radius(props)
+			radii.append(radius)
+			if radius > LARGE_LIGHT_RADIUS:
+				stats["big_lights"] += 1
+
+	stats["materials"] = len(materials)
+	return stats, classnames, materials, radii
+
+
+def validate_budget():
+	task("Checking map budgets... ")
+
+	limits = get_budget_limits()
+	resolver = load_entity_defs()
+	over = []
+
+	echo()
+	for map in map_parser.maps:
+		stats, classnames, materials, radii = get_map_budget(map, resolver)
+
+		echo(f"\n    > map '{map.name}'\n")
+		for key, val in stats.items():
+			flag = f"   over budget ({limits[key]})" if val > limits[key] else ""
+			echo(f"        {key:<16}{val:>8}{flag}")
+			if flag: over.append((map.name, key, val, limits[key]))
+
+		if radii:
+			echo(f"        {'light radius':<16}{sum(radii)/len(radii):>8.0f} average, {max(radii):.0f} max")
+
+		echo(f"\n        top classnames:")
+		for name, count in sorted(classnames.items(), key=lambda x: -x[1])[:BUDGET_TOP_COUNT]:
+			echo(f"            {count:>8}  {name}")
+
+		echo(f"\n        top materials (brushes and patches using them):")
+		for name, count in sorted(materials.items(), key=lambda x: -x[1])[:BUDGET_TOP_COUNT]:
+			echo(f"            {count:>8}  {name}")
+
+	if len(over) > 0:
+		echo("\n\n  Some maps are over budget\n")
+		for map_name, key, val, limit in over:
+			echo( REPORT_OBJECT.format(f"{map_name}: {val} {key}, limit is {limit}") )
+		echo( REPORT_COUNT.format(len(over), "budgets exceeded") )
+	else:
+		echo(f"\n  {REPORT_OK}\n")
+
+
+def get_mission_images():
+	images = {}
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		if os.path.splitext(arcname)[1].lower() in IMAGE_EXTENSIONS:
+			images[arcname.lower()] = (arcname, f.fullpath)
+	return images
+
+
+def find_image(images, name):
+	# dds versions are looked for first, like the engine does
+	name = os.path.splitext(name.lower())[0]
+	for key in ["dds/" + name + ".dds"] + [name + ext for ext in IMAGE_EXTENSIONS]:
+		if key in images: return key
+	return None
+
+
+def get_material_images():
+	material_images = {}
+	for path in get_included_files_in_dir("materials", ["*.mtr"]):
+		for d in parse_decls(read_text_file(os.path.join(mission.path, path))):
+			if d.type in ["", "material"]:
+				material_images[d.name.lower()] = [ t for t in d.body if '/' in t ]
+	return material_images
+
+
+def validate_textures():
+	task("Checking textures... ")
+
+	images = get_mission_images()
+	if not check_any_found(images, "textures"): return
+
+	paths = [ fullpath for arcname, fullpath in images.values() ]
+	with ThreadPoolExecutor(max_workers=get_worker_count()) as executor:
+		infos = dict(zip(paths, executor.map(scan_image, paths)))
+	infos = { key: infos[fullpath] for key, (arcname, fullpath) in images.items() }
+
+	unreadable, npot, oversized = [], [], []
+	for key, info in sorted(infos.items()):
+		arcname = images[key][0]
+		if info is None:
+			unreadable.append(arcname)
+			continue
+		desc = f"{arcname} ({info.width}x{info.height} {info.format})"
+		if not (is_power_of_two(info.width) and is_power_of_two(info.height)):
+			npot.append(desc)
+		if max(info.width, info.height) > MAX_TEXTURE_SIZE:
+			oversized.append(desc)
+
+	for items, header in (
+		(unreadable, "Some images could not be read"),
+		(npot,       "Some textures have dimensions that aren't powers of two"),
+		(oversized,  f"Some textures are larger than {MAX_TEXTURE_SIZE}"),
+	):
+		if not items: continue
+		echo(f"\n\n  {header}\n")
+		for item in items:
+			echo( REPORT_OBJECT.format(item) )
+		echo( REPORT_COUNT.format(len(items), "textures") )
+
+	if not (unreadable or npot or oversized):
+		echo(REPORT_OK)
+
+	# memory estimate, from the materials each map uses
+	material_images = get_material_images()
+	model_infos = { k.lower(): v for k, v in get_used_model_infos().items() }
+
+	echo("\n  Estimated memory of the mission's textures per map\n")
+	for map in map_parser.maps:
+		materials = set()
+		for e in map.entities:
+			materials.update(m.lower() for m in e.materials)
+			model = e.properties.get("model", "").replace('\\', '/').lower()
+			if model in model_infos:
+				materials.update(m.lower() for m in model_infos[model].materials)
+
+		used_images = set()
+		for mat in materials:
+			# a material without a decl is made from the image with its name
+			for name in material_images.get(mat, [mat]):
+				key = find_image(images, name)
+				if key and infos[key]: used_images.add(key)
+
+		total = sum(infos[key].get_memory_size() for key in used_images)
+		echo(f"        {map.name:<30} {total/MEGABYTE:>8.1f} MB  ({len(used_images)} textures)")
+	echo()
+
+
+def validate_geometry():
+	task("Checking geometry... ")
+
+	if np is None:
+		echo(" skipped, numpy is required for this check ('pip install numpy').")
+		return
+
+	bad_brushes = []
+	echo()
+	for map in map_parser.maps:
+		geo = map.geometry
+		mins, maxs = geo.get_brush_bounds()
+		ent_mins, ent_maxs = geo.get_entity_bounds(len(map.entities), mins, maxs)
+
+		echo(f"\n    > map '{map.name}'")
+		echo(f"        {len(geo.brush_entity)} brushes, {len(geo.patch_entity)} patches")
+
+		world = [ i for i in range(len(map.entities)) if map.entities[i].classname == "worldspawn" ]
+		if world and np.isfinite(ent_mins[world[0]]).all():
+			i = world[0]
+			size = ent_maxs[i] - ent_mins[i]
+			echo(f"        world extents  {format_vec(ent_mins[i])} to {format_vec(ent_maxs[i])}, size {format_vec(size)}")
+
+		if args.verbose:
+			echo(f"\n        entity bounds:")
+			for i in range(len(map.entities)):
+				if not np.isfinite(ent_mins[i]).all(): continue
+				echo(f"            {map.entities[i].get_key():<30} {format_vec(ent_mins[i])} to {format_vec(ent_maxs[i])}")
+
+		# degenerate brushes have no volume at all, and get no valid bounds
+		sizes = maxs - mins
+		degenerate = ~np.isfinite(sizes).all(axis=1) | (sizes <= 0).any(axis=1)
+		thickness = np.where(degenerate, 0, sizes.min(axis=1))
+		tiny = ~degenerate & (thickness < TINY_BRUSH_SIZE)
+
+		for b in np.nonzero(degenerate | tiny)[0]:
+			e = map.entities[geo.brush_entity[b]]
+			desc = "degenerate" if degenerate[b] else f"tiny, {thickness[b]:.2f} units thick"
+			bad_brushes.append(f"{map.name}: {e.get_key()}, primitive {geo.brush_ids[b]} ({desc})")
+
+	if bad_brushes:
+		echo("\n\n  Some brushes are degenerate or tiny\n")
+		for desc in bad_brushes:
+			echo( REPORT_OBJECT.format(desc) )
+		echo( REPORT_COUNT.format(len(bad_brushes), "bad brushes") )
+	else:
+		echo(f"\n  {REPORT_OK}\n")
+
+
+def format_vec(v):
+	return "(" + " ".join(f"{x:.0f}" for x in v) + ")"
+
+
+def parse_vec(text, default=None):
+	try:
+		v = [ float(x) for x in text.split() ]
+	except ValueError:
+		return default
+	if len(v) == 1: return (v[0], v[0], v[0])
+	return tuple(v[:3]) if len(v) >= 3 else default
+
+
+def get_light_volumes(map, resolver):
+	# axis-aligned boxes of the lights, ignoring any rotation
+	lights = []
+	for e in map.entities:
+		props = resolver.get_effective_properties(e)
+		if not is_light(e, props): continue
+		origin = parse_vec(props.get("origin", ""), (0.0, 0.0, 0.0))
+		center = parse_vec(props.get("light_center", ""), (0.0, 0.0, 0.0))
+		radius = parse_vec(props.get("light_radius", ""), (300.0, 300.0, 300.0))  # engine default
+		c = [ origin[i] + center[i] for i in range(3) ]
+		mins = tuple(c[i] - abs(radius[i]) for i in range(3))
+		maxs = tuple(c[i] + abs(radius[i]) for i in range(3))
+		lights.append((e, mins, maxs))
+	return lights
+
+
+def validate_light_overlap():
+	task("Checking overlapping lights... ")
+
+	limit = get_budget_limits()["light_overlap"]
+	resolver = load_entity_defs()
+	reports = []
+	for map in map_parser.maps:
+		lights = get_light_volumes(map, resolver)
+		if not lights: continue
+
+		# cells about twice the size of a typical light keep both the number of
+		# cells per light and the number of lights per cell low
+		sizes = sorted(maxs[0] - mins[0] for e, mins, maxs in lights)
+		grid = SpatialGrid(max(2 * sizes[len(sizes)//2], 64.0))
+		for i in range(len(lights)):
+			grid.insert(i, lights[i][1], lights[i][2])
+
+		counts = grid.count_overlaps([ (mins, maxs) for e, mins, maxs in lights ])
+		for i in range(len(lights)):
+			if counts[i] > limit:
+				reports.append((map.name, lights[i][0], counts[i]))
+
+	if reports:
+		echo(f"\n\n  Some lights overlap more than {limit} other lights\n")
+		for map_name, e, count in sorted(reports, key=lambda r: -r[2]):
+			echo( REPORT_OBJECT.format(f"{map_name}: {e.get_key():<30} {count} lights") )
+		echo( REPORT_COUNT.format(len(reports), "lights") )
+	else:
+		echo(REPORT_OK)
+
+
+def report_entities_near():
+	params = args.near.split()
+	try:
+		radius = float(params[-1])
+	except (ValueError, IndexError):
+		error(f"invalid argument '{args.near}' for '--near', use '<name|x y z> <radius>'")
+
+	parse_maps()
+	for map in map_parser.maps:
+		points = []
+		for e in map.entities:
+			origin = parse_vec(e.properties.get("origin", ""))
+			if origin: points.append((e, origin))
+
+		if len(params) == 4:
+			center = parse_vec(" ".join(params[:3]))
+		else:
+			named = [ p for e, p in points if e.name == params[0] ]
+			if not named:
+				echo(f"\n  No entity named '{params[0]}' with an origin in map '{map.name}'")
+				continue
+			center = named[0]
+		if not center:
+			error(f"invalid position '{' '.join(params[:3])}' for '--near'")
+
+		task(f"Entities within {radius:g} of {format_vec(center)} in map '{map.name}'... ")
+
+		grid = SpatialGrid(max(radius, 1.0))
+		for i in range(len(points)):
+			grid.insert(i, points[i][1], points[i][1])
+
+		mins = tuple(c - radius for c in center)
+		maxs = tuple(c + radius for c in center)
+		found = []
+		for i in grid.query_box(mins, maxs):
+			e, p = points[i]
+			dist = sum((p[k] - center[k])**2 for k in range(3)) ** 0.5
+			if dist <= radius:
+				found.append((dist, e))
+
+		if not found:
+			echo("none found")
+			continue
+		echo("\n")
+		for dist, e in sorted(found, key=lambda x: x[0]):
+			echo(f"        {dist:>8.1f}  {e.get_key():<30} {e.classname}")
+		echo(f"\n  {len(found)} entities\n")
+
+
+def get_used_sound_shaders(resolver):
+	# returns the shaders used by the map entities, which play positionally,
+	# and all the used shaders, including the ones from guis and scripts
+	positional = set()
+	for map in map_parser.maps:
+		for e in map.entities:
+			for key, val in resolver.get_effective_properties(e).items():
+				if key == "s_shader" or key.startswith("snd_"):
+					positional.add(val.lower())
+	used = positional | set(r.lower() for r in get_gui_script_references())
+	return positional, used
+
+
+def validate_sounds():
+	task("Checking sounds... ")
+
+	sound_files = {}
+	shaders = {}  # lowercase name : (name, decl file, sound files)
+	for f in mission.included.files:
+		arcname = get_arcname(f.relpath)
+		ext = os.path.splitext(arcname)[1].lower()
+		if ext in SOUND_EXTENSIONS:
+			sound_files[arcname.lower()] = (arcname, f.fullpath)
+		elif ext == ".sndshd":
+			for d in parse_decls(read_text_file(f.fullpath)):
+				if d.type in ["", "sound"]:
+					files = set( t.replace('\\', '/').lower() for t in d.body
+						if os.path.splitext(t)[1].lower() in SOUND_EXTENSIONS )
+					shaders[d.name.lower()] = (d.name, arcname, files)
+
+	if not check_any_found(sound_files or shaders, "sounds"): return
+
+	positional, used = get_used_sound_shaders(load_entity_defs())
+
+	unused_shaders = sorted( (decl_file, name)
+		for key, (name, decl_file, files) in shaders.items() if not key in used )
+
+	referenced = set(used)  # shaders can also be sound files used directly
+	positional_files = set(positional)
+	for key, (name, decl_file, files) in shaders.items():
+		referenced.update(files)
+		if key in positional: positional_files.update(files)
+	orphans = sorted( arcname for key, (arcname, fullpath) in sound_files.items() if not key in referenced )
+
+	paths = [ fullpath for arcname, fullpath in sound_files.values() ]
+	with ThreadPoolExecutor(max_workers=get_worker_count()) as executor:
+		infos = dict(zip(paths, executor.map(scan_sound, paths)))
+
+	stereo, long_sounds, unreadable = [], [], []
+	for key, (arcname, fullpath) in sorted(sound_files.items()):
+		info = infos[fullpath]
+		if info is None:
+			unreadable.append(arcname)
+			continue
+		desc = f"{arcname} ({info.channels} ch, {info.sample_rate} Hz, {info.duration:.1f} s)"
+		if args.verbose: echo(f"\n    {desc}", end="")
+		if info.channels > 1 and key in positional_files:
+			stereo.append(desc)
+		if info.duration > MAX_SOUND_DURATION:
+			long_sounds.append(desc)
+	if args.verbose: echo()
+
+	for items, header, count_name in (
+		([ f"{name}   ({decl_file})" for decl_file, name in unused_shaders ],
+			"Some sound shaders were not found in the maps, guis or scripts", "sound shaders"),
+		(orphans,     "Some sound files aren't used by any sound shader", "sound files"),
+		(stereo,      "Some sounds played by entities are stereo, and won't play positionally", "sound files"),
+		(long_sounds, f"Some sounds are longer than {MAX_SOUND_DURATION} seconds", "sound files"),
+		(unreadable,  "Some sound files could not be read", "sound files"),
+	):
+		if not items: continue
+		echo(f"\n\n  {header}\n")
+		for item in items:
+			echo( REPORT_OBJECT.format(item) )
+		echo( REPORT_COUNT.format(len(items), count_name) )
+
+	if not (unused_shaders or orphans or stereo or long_sounds or unreadable):
+		echo(REPORT_OK)
+
+
 def validate_entities():
 	task("Checking entities (experimental)... ")
 
 	files = parse_def_files("def", ["*.def"], include_prefixes=["entityDef"])
 	if not check_any_found(files, "entities"):	return
 
-	used = []
+	used = set(get_gui_script_references())
 	for map in map_parser.maps:
 		for e in map.entities:
-			used.append(e.classname)
+			used.add(e.classname)
 
 	if args.defs:
 		unused = check_unused_defs_in(files, used)
@@ -748,7 +2651,7 @@ def validate_files():
 
 
 
-check_params = "[\n  all, paths, files, models, materials, skins, particles,\n  entities, xdata\n]"
+check_params = "[\n  all, paths, files, models, materials, skins, particles,\n  entities, xdata, redundant, missing, budget, textures,\n  geometry, overlap, sounds\n]"
 
 VALIDATION_PARAMS = [
 	"paths",
@@ -759,6 +2662,13 @@ VALIDATION_PARAMS = [
 	"particles",
 	"entities",
 	"xdata",
+	"redundant",
+	"missing",
+	"budget",
+	"textures",
+	"geometry",
+	"overlap",
+	"sounds",
 ]
 
 _validate_funcs = {
@@ -770,11 +2680,21 @@ _validate_funcs = {
 	"particles" : validate_particles,
 	"entities"  : validate_entities,
 	"xdata"     : validate_xdata,
+	"redundant" : validate_redundant_files,
+	"missing"   : validate_missing_references,
+	"budget"    : validate_budget,
+	"textures"  : validate_textures,
+	"geometry"  : validate_geometry,
+	"overlap"   : validate_light_overlap,
+	"sounds"    : validate_sounds,
 }
 
 
 def validate_mission_files():
-	if not args.check in ["paths", "files"]:
+	if args.check in ["geometry", "all"] and np:
+		map_parser.keep_geometry = True
+
+	if not args.check in ["paths", "files", "redundant"]:
 		parse_maps()
 
 	if args.check == "all":
@@ -819,21 +2739,22 @@ def validate_ents_and_props(ents, props):
 		k_has_wildcard = '*' in k
 		v_has_wildcard = '*' in v
 		for e in ents:
+			properties = e.get_properties()
 			if not k_has_wildcard:
-				if not k in e.properties \
+				if not k in properties \
 				or v == '?':
 					invalid_entities.append(e)
 					continue
 
 				if v_has_wildcard:
-					if not fnmatch(e.properties[k], v):
+					if not fnmatch(properties[k], v):
 						invalid_entities.append(e)
 				else:
-					if v != e.properties[k]:
+					if v != properties[k]:
 						invalid_entities.append(e)
 			else:
 				match = None
-				for p in e.properties:
+				for p in properties:
 					if fnmatch(p, k):
 						match = p
 
@@ -843,10 +2764,10 @@ def validate_ents_and_props(ents, props):
 						continue
 
 					if v_has_wildcard:
-						if not fnmatch(e.properties[match], v):
+						if not fnmatch(properties[match], v):
 							invalid_entities.append(e)
 					else:
-						if v != e.properties[match]:
+						if v != properties[match]:
 							invalid_entities.append(e)
 	return invalid_entities
 
@@ -863,6 +2784,65 @@ def validate_ents_and_props2(ents, props):
 	return invalid_entities
 
 
+def validate_ents_and_props_cached(map, query, ents, props, resolver):
+	# only the entities that changed since the last run with the same query
+	# are validated again, the results for the others come from the cache
+	cache = load_entity_cache(map.name)
+	queries = cache.setdefault("queries", {})
+	prev_results = queries.get(query, {})
+
+	results = {}
+	num_validated = 0
+	for e in ents:
+		key = e.get_key()
+		# the entityDef is part of the hash, since its values are inherited
+		ent_hash = f"{e.hash}:{resolver.get_hash(e.classname)}"
+		res = prev_results.get(key)
+		if res and res[0] == ent_hash:
+			results[key] = res
+			continue
+		e.effective_properties = resolver.get_effective_properties(e)
+		failed = [ j for j in range(len(props)) if validate_ents_and_props([e], [props[j]]) ]
+		results[key] = [ent_hash, failed]
+		num_validated += 1
+
+	if args.verbose:
+		echo(f"\n    {num_validated} entities validated, {len(ents)-num_validated} from cache... ", end="")
+
+	queries[query] = results
+	save_entity_cache(map.name, cache)
+
+	# keep the same order 'validate_ents_and_props' would give
+	invalid_ents = []
+	for j in range(len(props)):
+		for e in ents:
+			if j in results[e.get_key()][1]:
+				invalid_ents.append(e)
+	return invalid_ents
+
+
+def report_entity_changes():
+	for map in map_parser.maps:
+		task(f"Checking entity changes in map '{map.name}'... ")
+
+		if not map.prev_hashes:
+			echo(" no previous run to compare with.")
+			continue
+
+		added, removed, changed = diff_entity_hashes(map.prev_hashes, map.get_entity_hashes())
+		if not (added or removed or changed):
+			echo("no changes")
+			continue
+
+		echo()
+		for header, keys in (("added", added), ("removed", removed), ("changed", changed)):
+			if not keys: continue
+			echo(f"\n    {header}:")
+			for key in keys:
+				echo( REPORT_OBJECT.format(key) )
+		echo(f"\n  {len(added)} added, {len(removed)} removed, {len(changed)} changed\n")
+
+
 def check_entity_properties():
 	parse_maps()
 
@@ -874,6 +2854,8 @@ def check_entity_properties():
 	attr = ident_params[0]
 	ident = ident_params[1]
 	props = [ params[i].split(' ') for i in range(1, len(params)) ]
+	query = ','.join(params)
+	resolver = load_entity_defs()
 
 	for i in range(len(map_parser.maps)):
 		map = map_parser.maps[i]
@@ -886,7 +2868,7 @@ def check_entity_properties():
 		if len(ents) == 0:
 			echo(f"\n\n  No entities found with {attr} '{ident}'")
 		else:
-			invalid_ents = validate_ents_and_props(ents, props)
+			invalid_ents = validate_ents_and_props_cached(map, query, ents, props, resolver)
 
 			if len(invalid_ents) > 0:
 				echo(f"\n\n    Entities differ:")
@@ -903,6 +2885,438 @@ def check_entity_properties():
 
 
 
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+# 		DECL PARSER
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+# decl kinds by file extension, and the decl type keyword of each kind
+# (an empty keyword is for decls declared with just a name)
+DECL_KINDS = {
+	".mtr"    : { "": "material", "material": "material" },
+	".skin"   : { "skin": "skin" },
+	".prt"    : { "particle": "particle" },
+	".def"    : { "entityDef": "entityDef", "model": "model" },
+	".xd"     : { "": "xdata" },
+	".sndshd" : { "": "sound", "sound": "sound" },
+}
+
+# the directories where the engine looks for each file type
+DECL_DIRS = {
+	".mtr"    : ["materials"],
+	".skin"   : ["skins"],
+	".prt"    : ["particles"],
+	".def"    : ["def"],
+	".xd"     : ["xdata"],
+	".sndshd" : ["sound"],
+}
+
+_decl_token_re = re.compile(r'''
+	(//[^\n]* | /\*.*?(?:\*/|\Z))           # comments
+	| ("(?:\\.|[^"\\])*"?)                  # strings
+	| ([{}()\[\],;=])                         # punctuation
+	| ((?:[^\s{}()\[\],;="/] | /(?![/*]))+)   # anything else
+''', re.S | re.X)
+
+
+def tokenize_decl(text):
+	# yields (token, start) pairs, with the quotes kept in strings
+	for m in _decl_token_re.finditer(text):
+		if m.lastindex == 1: continue
+		yield m.group(m.lastindex), m.start()
+
+
+def unquote(token):
+	if token.startswith('"'):
+		return token[1:-1] if token.endswith('"') and len(token) > 1 else token[1:]
+	return token
+
+
+class Decl:
+	__slots__ = ("type", "name", "start", "end", "body")
+
+	def __init__(self, type, name, start, end, body):
+		self.type  = type   # the type keyword, or "" if there was none
+		self.name  = name
+		self.start = start  # span of the decl in the text, from its type or name
+		self.end   = end
+		self.body  = body   # the unquoted tokens inside the outer braces
+
+
+def parse_decls(text):
+	decls = []
+	header = []
+	starts = []
+	tokens = tokenize_decl(text)
+	for token, pos in tokens:
+		if token != '{':
+			if token == '}': continue  # stray brace
+			header.append(unquote(token))
+			starts.append(pos)
+			continue
+
+		body = []
+		level = 1
+		end = len(text)
+		for token, pos in tokens:
+			if   token == '{': level += 1
+			elif token == '}': level -= 1
+			if level == 0:
+				end = pos + 1
+				break
+			body.append(unquote(token))
+
+		if header:
+			# anything before the last two tokens isn't part of this decl
+			name = header[-1]
+			type = header[-2] if len(header) > 1 else ""
+			start = starts[-2] if len(header) > 1 else starts[-1]
+			decls.append(Decl(type, name, start, end, body))
+		header = []
+		starts = []
+	return decls
+
+
+def parse_entity_defs(text):
+	defs = {}
+	for d in parse_decls(text):
+		if d.type != "entityDef": continue
+		body = d.body
+		defs[d.name.lower()] = { body[i]: body[i+1] for i in range(0, len(body)-1, 2) }
+	return defs
+
+
+class EntityDefResolver:
+	def __init__(self, defs):
+		self.defs = defs      # { lowercase name : own key/values }
+		self.resolved = {}    # memoized flattened key/values
+		self.hashes = {}
+
+	def resolve(self, classname, chain=()):
+		name = classname.lower()
+		if name in self.resolved:
+			return self.resolved[name]
+
+		own = self.defs.get(name)
+		if own is None or name in chain:  # unknown def or circular inheritance
+			return {}
+
+		parent = own.get("inherit")
+		props = dict(self.resolve(parent, chain + (name,))) if parent else {}
+		props.update(own)
+		self.resolved[name] = props
+		return props
+
+	def get_hash(self, classname):
+		name = classname.lower()
+		if not name in self.hashes:
+			data = json.dumps(self.resolve(name), sort_keys=True).encode()
+			self.hashes[name] = hashlib.blake2b(data, digest_size=8).hexdigest()
+		return self.hashes[name]
+
+	def get_effective_properties(self, e):
+		props = dict(self.resolve(e.classname))
+		props.update(e.properties)
+		return props
+
+
+def get_gui_references(text):
+	refs = set()
+	prev = ""
+	for token, pos in tokenize_decl(text):
+		val = unquote(token)
+		if prev in GUI_REF_KEYS:
+			refs.add(val)
+		elif token.startswith('"') and val.startswith("play "):  # set "cmd" "play <sound>"
+			refs.update(val.split()[1:2])
+		prev = token.lower()
+	refs.discard("")
+	return refs
+
+
+def get_script_references(text):
+	refs = set()
+	for token, pos in tokenize_decl(text):
+		if token.startswith('"'):
+			refs.add(unquote(token))
+		elif token.startswith('$'):  # $entity_name.someEvent
+			refs.add(token[1:].split('.')[0])
+	refs.discard("")
+	return refs
+
+
+def get_decl_names(text, ext):
+	kinds = DECL_KINDS[ext]
+	names = {}
+	for d in parse_decls(text):
+		kind = kinds.get(d.type)
+		if not kind: continue
+		if not kind in names: names[kind] = []
+		names[kind].append(d.name)
+	return names
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+# 		MODEL SCANNER
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+class ModelInfo:
+	def __init__(self):
+		self.materials = set()
+		self.triangles = 0
+
+
+_ase_re = re.compile(rb'\*(MATERIAL_NAME|BITMAP|MESH_NUMFACES)\s+("[^"\r\n]*"|\d+)')
+
+
+def get_ase_bitmap_material(path):
+	# the engine names the material after the bitmap path, relative to 'base/'
+	path = path.replace('\\', '/')
+	i = path.lower().rfind("base/")
+	if i >= 0: path = path[i+5:]
+	return os.path.splitext(path.lstrip('/'))[0]
+
+
+def scan_ase(mm):
+	info = ModelInfo()
+	for m in _ase_re.finditer(mm):
+		key, val = m.group(1), m.group(2).decode("latin-1")
+		if   key == b"MESH_NUMFACES": info.triangles += int(val)
+		elif key == b"MATERIAL_NAME": info.materials.add(val.strip('"'))
+		else:                         info.materials.add(get_ase_bitmap_material(val.strip('"')))
+	info.materials.discard("")
+	return info
+
+
+_md5mesh_re = re.compile(rb'\b(shader|numtris)\s+("[^"\r\n]*"|\d+)')
+
+
+def scan_md5mesh(mm):
+	info = ModelInfo()
+	for m in _md5mesh_re.finditer(mm):
+		key, val = m.group(1), m.group(2).decode("latin-1")
+		if key == b"numtris": info.triangles += int(val)
+		else:                 info.materials.add(val.strip('"'))
+	info.materials.discard("")
+	return info
+
+
+def read_lwo_string(mm, pos, end):
+	# strings are null-terminated and padded to an even length
+	nul = mm.find(b'\0', pos, end)
+	if nul < 0: raise ValueError("unterminated string")
+	s = mm[pos:nul].decode("latin-1")
+	return s, nul + 1 + ((nul + 1 - pos) & 1)
+
+
+def count_lwo2_triangles(mm, pos, end):
+	triangles = 0
+	while pos < end:
+		num_verts = struct.unpack_from(">H", mm, pos)[0] & 0x03FF
+		pos += 2
+		for _ in range(num_verts):
+			pos += 4 if mm[pos] == 0xFF else 2  # variable length index
+		triangles += max(num_verts - 2, 0)
+	return triangles
+
+
+def scan_lwo(mm):
+	info = ModelInfo()
+	if len(mm) < 12 or mm[0:4] != b"FORM": return info
+	form = mm[8:12]
+	pos = 12
+	end = min(len(mm), 8 + struct.unpack_from(">I", mm, 4)[0])
+
+	# only the chunk headers are read, except for the chunks we want
+	while pos + 8 <= end:
+		chunk_id = mm[pos:pos+4]
+		size = struct.unpack_from(">I", mm, pos+4)[0]
+		data = pos + 8
+		chunk_end = min(data + size, end)
+		if chunk_id == b"SURF":
+			info.materials.add(read_lwo_string(mm, data, chunk_end)[0])
+		elif chunk_id == b"SRFS":  # LWOB surface names
+			p = data
+			while p < chunk_end:  # each string moves it forward by 2 at least
+				name, p = read_lwo_string(mm, p, chunk_end)
+				info.materials.add(name)
+		elif chunk_id == b"POLS" and form == b"LWO2":
+			if mm[data:data+4] in (b"FACE", b"PTCH"):
+				info.triangles += count_lwo2_triangles(mm, data+4, chunk_end)
+		pos = data + size + (size & 1)
+
+	info.materials.discard("")
+	return info
+
+
+def scan_model(path):
+	ext = os.path.splitext(path)[1].lower()
+	if not ext in SCANNED_MODEL_EXTENSIONS: return None
+	if os.path.getsize(path) == 0: return ModelInfo()
+
+	# mapped rather than read, so only the pages that are touched get loaded
+	with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		try:
+			if   ext == ".ase":     return scan_ase(mm)
+			elif ext == ".md5mesh": return scan_md5mesh(mm)
+			else:                   return scan_lwo(mm)
+		except (struct.error, IndexError, ValueError):
+			warning(f"model '{path}' could not be scanned, it may be corrupt")
+			return None
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+# 		IMAGE SCANNER
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+class ImageInfo:
+	def __init__(self, width, height, format, bpp, mips=None):
+		self.width  = width
+		self.height = height
+		self.format = format
+		self.bpp    = bpp    # bytes per pixel once loaded
+		self.mips   = mips   # mip levels stored in the file, None if generated when loaded
+
+	def get_memory_size(self):
+		size = self.width * self.height * self.bpp
+		if self.mips == 1: return int(size)
+		return int(size * 4 / 3)  # a full mip chain adds a third
+
+
+def is_power_of_two(n):
+	return n > 0 and n & (n - 1) == 0
+
+
+def read_dds_header(f):
+	data = f.read(128)
+	if len(data) < 128 or data[:4] != b"DDS ": return None
+	height, width = struct.unpack_from("<II", data, 12)
+	mips = struct.unpack_from("<I", data, 28)[0] or 1
+	pf_flags = struct.unpack_from("<I", data, 80)[0]
+	if pf_flags & 0x4:  # DDPF_FOURCC
+		fourcc = data[84:88].decode("latin-1").strip('\0 ')
+		bpp = DDS_FORMAT_BPP.get(fourcc, 1.0)
+		return ImageInfo(width, height, fourcc, bpp, mips)
+	bits = struct.unpack_from("<I", data, 88)[0]
+	return ImageInfo(width, height, f"RGB{bits}", bits / 8, mips)
+
+
+def read_tga_header(f):
+	data = f.read(18)
+	if len(data) < 18: return None
+	width, height, bits = struct.unpack_from("<HHB", data, 12)
+	return ImageInfo(width, height, f"tga{bits}", 4)
+
+
+def read_png_header(f):
+	data = f.read(26)
+	if len(data) < 26 or data[:8] != b"\x89PNG\r\n\x1a\n": return None
+	width, height = struct.unpack_from(">II", data, 16)
+	return ImageInfo(width, height, "png", 4)
+
+
+def read_jpg_header(f):
+	if f.read(2) != b"\xff\xd8": return None
+	# walk the segment headers until the frame header with the dimensions
+	while True:
+		marker = f.read(4)
+		if len(marker) < 4 or marker[0] != 0xFF: return None
+		kind = marker[1]
+		length = struct.unpack(">H", marker[2:])[0]
+		if 0xC0 <= kind <= 0xCF and not kind in (0xC4, 0xC8, 0xCC):
+			data = f.read(5)
+			if len(data) < 5: return None
+			height, width = struct.unpack_from(">HH", data, 1)
+			return ImageInfo(width, height, "jpg", 4)
+		f.seek(length - 2, os.SEEK_CUR)
+
+
+_image_readers = {
+	".dds" : read_dds_header,
+	".tga" : read_tga_header,
+	".png" : read_png_header,
+	".jpg" : read_jpg_header,
+}
+
+
+def scan_image(path):
+	# only the headers are read
+	reader = _image_readers.get(os.path.splitext(path)[1].lower())
+	if not reader: return None
+	try:
+		with open(path, 'rb') as f:
+			return reader(f)
+	except (OSError, struct.error):
+		return None
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+# 		SOUND SCANNER
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+OGG_TAIL_SIZE = 64 * 1024  # the last page, with the total sample count, is in here
+
+
+class SoundInfo:
+	def __init__(self, channels, sample_rate, duration):
+		self.channels    = channels
+		self.sample_rate = sample_rate
+		self.duration    = duration
+
+
+def read_wav_header(f):
+	data = f.read(12)
+	if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE": return None
+	channels = sample_rate = byte_rate = None
+	# walk the chunk headers, skipping the audio itself
+	while True:
+		header = f.read(8)
+		if len(header) < 8: return None
+		chunk_id, size = header[:4], struct.unpack("<I", header[4:])[0]
+		if chunk_id == b"fmt ":
+			fmt = f.read(16)
+			channels, sample_rate, byte_rate = struct.unpack_from("<HII", fmt, 2)
+			f.seek(size - 16 + (size & 1), os.SEEK_CUR)
+		elif chunk_id == b"data":
+			if channels is None: return None
+			return SoundInfo(channels, sample_rate, size / byte_rate if byte_rate else 0.0)
+		else:
+			f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def read_ogg_header(f):
+	head = f.read(4096)
+	if head[:4] != b"OggS": return None
+	i = head.find(b"\x01vorbis")
+	if i < 0 or i + 16 > len(head): return None
+	channels, sample_rate = struct.unpack_from("<BI", head, i + 11)
+
+	# the granule position of the last page is the total number of samples
+	f.seek(0, os.SEEK_END)
+	size = f.tell()
+	f.seek(max(0, size - OGG_TAIL_SIZE))
+	tail = f.read()
+	j = tail.rfind(b"OggS")
+	samples = struct.unpack_from("<q", tail, j + 6)[0] if j >= 0 and j + 14 <= len(tail) else 0
+	duration = samples / sample_rate if sample_rate and samples > 0 else 0.0
+	return SoundInfo(channels, sample_rate, duration)
+
+
+def scan_sound(path):
+	# only the headers are read, nothing is decoded
+	ext = os.path.splitext(path)[1].lower()
+	try:
+		with open(path, 'rb') as f:
+			if ext == ".wav": return read_wav_header(f)
+			if ext == ".ogg": return read_ogg_header(f)
+	except (OSError, struct.error):
+		pass
+	return None
+
+
+
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 # 		MAP PARSER
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
@@ -927,6 +3341,17 @@ class Entity:
 		self.brushes = []
 		self.patches = []
 		self.materials = set()
+		self.hash = ""
+		self.effective_properties = None  # includes the inherited values, if resolved
+
+	def get_properties(self):
+		if self.effective_properties is not None:
+			return self.effective_properties
+		return self.properties
+
+	def get_key(self):
+		# the name is the most stable identifier, when there is one
+		return self.name if self.name else f"entity {self.id}"
 
 class Property:
 	def __init__(self, name, value):
@@ -945,7 +3370,13 @@ class Patch:
 
 class MapData:
 	def __init__(self):
+		self.name = ""
 		self.entities = []
+		self.prev_hashes = {}
+		self.geometry = None  # MapGeometry, only when parsing with 'keep_geometry'
+
+	def get_entity_hashes(self):
+		return { e.get_key(): e.hash for e in self.entities }
 
 class MapParser:
 	def __init__(self):
@@ -961,6 +3392,9 @@ class MapParser:
 		self.curr_primitive_id  = -1
 		self.curr_entity_id     = -1
 
+		self.keep_geometry = False
+		self.geometry      = None
+
 	def set_scope(self, scope):
 		if debug_show_scopes: print(">", scope)
 		self.scope = scope
@@ -997,9 +3431,13 @@ class MapParser:
 			# self.print_scope("Scope.Def", token)
 			if   token.startswith("brushDef"):
 				self.curr_brush = Brush(self.curr_primitive_id)
+				if self.geometry:
+					self.geometry.begin_brush(len(self.curr_map.entities), self.curr_primitive_id)
 				self.set_scope(Scope.BrushDef)
 			elif token.startswith("patchDef"):
 				self.curr_patch = Patch(self.curr_primitive_id)
+				if self.geometry:
+					self.geometry.begin_patch(len(self.curr_map.entities))
 				self.set_scope(Scope.PatchDef)
 			elif token == '}':
 				self.set_scope(Scope.Entity)
@@ -1053,6 +3491,9 @@ class MapParser:
 
 		if args.verbose: task(f"    '{os.path.basename(map_file)}'...")
 
+		hashers = {}
+		self.geometry = GeometryBuilder() if self.keep_geometry else None
+
 		t1 = time.time()
 		with open(map_file, 'r') as file:
 
@@ -1060,10 +3501,21 @@ class MapParser:
 				line = line.replace('\n', '')
 				# line = line.replace('\t', '')
 
+				if self.curr_ent:
+					hasher = hashers.get(self.curr_ent)
+					if not hasher:
+						hasher = hashers[self.curr_ent] = hashlib.blake2b(digest_size=16)
+					hasher.update(line.encode())
+
 				line_start = line[0]
 
 				if line_start == '(':
 					assert self.scope in [Scope.PatchDef, Scope.BrushDef], line
+					if self.geometry:
+						if self.scope == Scope.BrushDef:
+							self.geometry.add_face(line[:line.find('"')])
+						elif line.startswith("( ("):
+							self.geometry.add_patch_row(line)
 					# when it's brush or patch, skip the faces
 					if "textures" in line:  # brush
 						q1 = line.find('"')
@@ -1106,6 +3558,195 @@ class MapParser:
 		for e in self.curr_map.entities:
 			if "texture" in e.properties:
 				e.materials.add(e.properties["texture"])
+			if e in hashers:
+				e.hash = hashers[e].hexdigest()
+
+		if self.geometry:
+			self.curr_map.geometry = self.geometry.build()
+			self.geometry = None
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+# 		MAP GEOMETRY
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+GEOMETRY_EPSILON   = 0.01
+GEOMETRY_CHUNK     = 4000000  # max elements per vectorized step, to bound memory
+
+
+class GeometryBuilder:
+	# collects the raw text during parsing, and converts it all at once at the end
+	def __init__(self):
+		self.face_text    = []
+		self.face_brush   = array('I')
+		self.brush_entity = array('I')
+		self.brush_ids    = array('i')
+		self.patch_text   = []
+		self.patch_rows   = array('I')  # patch index of each row of control points
+		self.patch_entity = array('I')
+
+	def begin_brush(self, entity_index, primitive_id):
+		self.brush_entity.append(entity_index)
+		self.brush_ids.append(primitive_id)
+
+	def begin_patch(self, entity_index):
+		self.patch_entity.append(entity_index)
+
+	def add_face(self, text):
+		self.face_text.append(text)
+		self.face_brush.append(len(self.brush_entity) - 1)
+
+	def add_patch_row(self, text):
+		self.patch_text.append(text)
+		self.patch_rows.append(len(self.patch_entity) - 1)
+
+	def build(self):
+		# faces are '( a b c d ) ( ( tx ) ( ty ) )', 10 numbers before the material
+		text = " ".join(self.face_text).replace('(', ' ').replace(')', ' ')
+		faces = np.fromstring(text, dtype=np.float64, sep=' ').reshape(-1, 10)
+
+		# a row of control points has 5 numbers per point, xyz and uv
+		points = np.zeros((0, 3))
+		point_patch = np.zeros(0, dtype=np.int64)
+		if self.patch_text:
+			row_sizes = [ row.count('(') - 1 for row in self.patch_text ]
+			text = " ".join(self.patch_text).replace('(', ' ').replace(')', ' ')
+			points = np.fromstring(text, dtype=np.float64, sep=' ').reshape(-1, 5)[:, :3]
+			point_patch = np.repeat(np.frombuffer(self.patch_rows, dtype=np.uint32), row_sizes)
+
+		return MapGeometry(
+			faces[:, :4],
+			np.frombuffer(self.face_brush,   dtype=np.uint32).astype(np.int64),
+			np.frombuffer(self.brush_entity, dtype=np.uint32).astype(np.int64),
+			np.frombuffer(self.brush_ids,    dtype=np.int32).copy(),
+			points,
+			point_patch.astype(np.int64),
+			np.frombuffer(self.patch_entity, dtype=np.uint32).astype(np.int64),
+		)
+
+
+class MapGeometry:
+	def __init__(self, planes, face_brush, brush_entity, brush_ids, points, point_patch, patch_entity):
+		self.planes       = planes        # (faces, 4), the plane of each face as 'n.p + d = 0'
+		self.face_brush   = face_brush    # (faces,), brush index of each face
+		self.brush_entity = brush_entity  # (brushes,), entity index of each brush
+		self.brush_ids    = brush_ids     # (brushes,), primitive id of each brush
+		self.points       = points        # (points, 3), patch control points
+		self.point_patch  = point_patch   # (points,), patch index of each point
+		self.patch_entity = patch_entity  # (patches,), entity index of each patch
+
+	def get_brush_bounds(self):
+		# the vertices of a brush are the intersections of three of its planes
+		# that are inside all of the others. Brushes are handled in groups
+		# with the same number of faces, so that everything is vectorized
+		num_brushes = len(self.brush_entity)
+		mins = np.full((num_brushes, 3),  np.inf)
+		maxs = np.full((num_brushes, 3), -np.inf)
+		if num_brushes == 0: return mins, maxs
+
+		counts = np.bincount(self.face_brush, minlength=num_brushes)
+		starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+		for k in np.unique(counts):
+			if k < 4: continue  # can't enclose a volume
+			brushes = np.nonzero(counts == k)[0]
+			# the triples are split too, so that brushes with many faces
+			# (C(k, 3) triples, each tested against k planes) stay in bounds
+			triple_step = max(1, GEOMETRY_CHUNK // (k * 3))
+			combos = combinations(range(k), 3)
+			while True:
+				triples = np.fromiter(chain.from_iterable(islice(combos, triple_step)), dtype=np.intp)
+				if not len(triples): break
+				triples = triples.reshape(-1, 3)
+				step = max(1, GEOMETRY_CHUNK // (len(triples) * k * 3))
+				for i in range(0, len(brushes), step):
+					chunk = brushes[i:i+step]
+					planes = self.planes[starts[chunk][:, None] + np.arange(k)]  # (n, k, 4)
+					normals = planes[:, triples, :3]                              # (n, t, 3, 3)
+					dists = -planes[:, triples, 3]                                # (n, t, 3)
+
+					det = np.linalg.det(normals)
+					valid = np.abs(det) > 1e-9
+					verts = np.zeros(dists.shape)
+					verts[valid] = np.linalg.solve(normals[valid], dists[valid][..., None])[..., 0]
+
+					side = np.einsum('nti,nki->ntk', verts, planes[:, :, :3]) + planes[:, None, :, 3]
+					inside = valid & (side <= GEOMETRY_EPSILON).all(axis=2)
+
+					mask = inside[..., None]
+					mins[chunk] = np.minimum(mins[chunk], np.where(mask, verts,  np.inf).min(axis=1))
+					maxs[chunk] = np.maximum(maxs[chunk], np.where(mask, verts, -np.inf).max(axis=1))
+
+		return mins, maxs
+
+	def get_entity_bounds(self, num_entities, brush_mins, brush_maxs):
+		mins = np.full((num_entities, 3),  np.inf)
+		maxs = np.full((num_entities, 3), -np.inf)
+
+		ok = np.isfinite(brush_mins).all(axis=1)
+		np.minimum.at(mins, self.brush_entity[ok], brush_mins[ok])
+		np.maximum.at(maxs, self.brush_entity[ok], brush_maxs[ok])
+
+		if len(self.points):
+			point_entity = self.patch_entity[self.point_patch]
+			np.minimum.at(mins, point_entity, self.points)
+			np.maximum.at(maxs, point_entity, self.points)
+
+		return mins, maxs
+
+
+
+class SpatialGrid:
+	# uniform grid over axis-aligned boxes, for radius and overlap queries
+	def __init__(self, cell_size):
+		self.cell_size = cell_size
+		self.cells = {}
+
+	def get_cell_range(self, mins, maxs):
+		lo = [ int(math.floor(v / self.cell_size)) for v in mins ]
+		hi = [ int(math.floor(v / self.cell_size)) for v in maxs ]
+		return [ (x, y, z)
+			for x in range(lo[0], hi[0]+1)
+				for y in range(lo[1], hi[1]+1)
+					for z in range(lo[2], hi[2]+1) ]
+
+	def insert(self, item, mins, maxs):
+		for cell in self.get_cell_range(mins, maxs):
+			self.cells.setdefault(cell, []).append(item)
+
+	def query_box(self, mins, maxs):
+		found = set()
+		for cell in self.get_cell_range(mins, maxs):
+			found.update(self.cells.get(cell, ()))
+		return found
+
+	def count_overlaps(self, boxes):
+		# 'boxes' are the (mins, maxs) of the inserted items. A pair of boxes
+		# shares several cells, but is only counted in the cell holding the
+		# min corner of their intersection, so no pair sets are needed
+		size = self.cell_size
+		counts = [0] * len(boxes)
+		for cell, items in self.cells.items():
+			for a in range(len(items)):
+				i = items[a]
+				(ax0, ay0, az0), (ax1, ay1, az1) = boxes[i]
+				for b in range(a+1, len(items)):
+					j = items[b]
+					(bx0, by0, bz0), (bx1, by1, bz1) = boxes[j]
+					if ax0 >= bx1 or bx0 >= ax1 or ay0 >= by1 or by0 >= ay1 \
+					or az0 >= bz1 or bz0 >= az1:
+						continue
+					ref = (
+						int(math.floor(max(ax0, bx0) / size)),
+						int(math.floor(max(ay0, by0) / size)),
+						int(math.floor(max(az0, bz0) / size)),
+					)
+					if ref == cell:
+						counts[i] += 1
+						counts[j] += 1
+		return counts
+
+
 
 
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
@@ -1128,8 +3769,15 @@ if __name__ == "__main__":
 	parser.add_argument("--version",           action="version",    version=f"FM Packer v{VERSION} for The Dark Mod\n\n")
 	parser.add_argument("-qh", "--quick_help", action="store_true", help="show a shortened help message\n\n")
 
-	parser.add_argument("path",    type=str, const=None, nargs='?',
-		help="the path (relative or absolute) to the target fm\n\n")
+	parser.add_argument("path",    type=str, nargs='*',
+		help= \
+				"the path (relative or absolute) to the target fm.\n"
+				"Several paths, or a directory containing fms, can be\n"
+				"given to pack all of them in one go\n\n"
+	)
+
+	parser.add_argument("-j", "--jobs", type=int, metavar="n",
+		help="number of parallel workers to use (default: one per cpu)\n\n")
 
 	parser.add_argument("--pkset", type=str, metavar="[csv/ssv]",
 		help= \
@@ -1140,6 +3788,43 @@ if __name__ == "__main__":
 
 	parser.add_argument("-v", "--verbose", action="store_true", help="show more information during the process.")
 
+	parser.add_argument("-q", "--quiet", action="store_true",
+		help="don't show the progress while packing.\n\n")
+
+	parser.add_argument("--deterministic", action="store_true",
+		help= \
+				"pack reproducibly: sorted entries with fixed timestamps and\n"
+				"permissions, and a manifest of the packed files next to the\n"
+				"pk4. Packing is skipped if nothing changed since the last time\n\n"
+	)
+
+	parser.add_argument("--release", action="store_true",
+		help= \
+				"pack with the smallest deflate streams found by trying\n"
+				"several zlib settings on each file, and report the size saved\n"
+				"per file type. Slower, meant for public releases\n\n"
+	)
+
+	parser.add_argument("--minify", action="store_true",
+		help= \
+				"strip comments and whitespace from the .mtr, .def, .skin,\n"
+				".prt, .gui, .script and .xd files as they're packed. The\n"
+				"source files aren't changed\n\n"
+	)
+
+	parser.add_argument("--strip_unused", action="store_true",
+		help= \
+				"leave the materials, skins, particles and xdata that aren't\n"
+				"used by the maps, models, guis or scripts out of the decl\n"
+				"files as they're packed. The source files aren't changed\n\n"
+	)
+
+	parser.add_argument("--pack_log", type=str, metavar="file",
+		help= \
+				"write a tab-separated log of the packed files, with their\n"
+				"size and compressed size\n\n"
+	)
+
 	parser.add_argument("--pkget", action="store_true",
 		help= "outputs the .pkignore content as csv filters\n\n")
 
@@ -1171,12 +3856,60 @@ if __name__ == "__main__":
 				"containing that property, regardless of its value.\n\n"
 	)
 
+	parser.add_argument("--limits", type=str, metavar="[params]",
+		help= \
+				"change the limits used by '-c budget', as a comma-separated\n"
+				"string of <name number>. E.g. \"lights 300, brushes 10000\"\n\n"
+	)
+
 	parser.add_argument("-d", "--defs", default=False, action="store_true",
 		help= \
 				"when looking up definitions (eg '-c skins'), report individual\n"
 				"unused definitions, instead of files with no used definitions.\n\n"
 	)
 
+	parser.add_argument("--verify", type=str, const="", nargs='?', metavar="pk4",
+		help= \
+				"check that the pk4 matches the files that would be packed,\n"
+				"comparing sizes and CRCs without decompressing anything.\n"
+				"If 'pk4' is ommitted, '<mission name>.pk4' is used\n\n"
+	)
+
+	parser.add_argument("--base", type=str, metavar="tdm_path",
+		help= \
+				"path to the game directory, used for detecting files that\n"
+				"are identical to stock assets. The contents of its pk4s are\n"
+				"indexed once and cached\n\n"
+	)
+
+	parser.add_argument("-w", "--where", type=str, metavar="name",
+		help= \
+				"list where a material, model, skin, particle, xdata or any\n"
+				"other name is referenced in the maps, decls, guis, scripts\n"
+				"and models. A wildcard '*' can be used\n\n"
+	)
+
+	parser.add_argument("--diff", type=str, metavar="pk4",
+		help= \
+				"list the files that were added, modified or removed since\n"
+				"the given pk4 was packed, without decompressing it\n\n"
+	)
+
+	parser.add_argument("--diff_out", type=str, metavar="pk4",
+		help="with '--diff', also write a pk4 with only the changed files\n\n")
+
+	parser.add_argument("--near", type=str, metavar="\"<name|x y z> r\"",
+		help= \
+				"list the entities within radius 'r' of the named entity or\n"
+				"of the given position. E.g. \"light_12 256\" or \"0 0 64 512\"\n\n"
+	)
+
+	parser.add_argument("--changes", action="store_true",
+		help= \
+				"list the entities that were added, removed or changed in\n"
+				"each map since the last run\n\n"
+	)
+
 	args = parser.parse_args()
 	# print(args)
 
@@ -1199,22 +3932,70 @@ if __name__ == "__main__":
 	if not args.path:
 		error("a path must be provided")
 
-	set_fm_path(args.path)
+	if args.base:
+		args.base = os.path.abspath(args.base)
+	if args.pack_log:
+		args.pack_log = os.path.abspath(args.pack_log)
+
+	mission_paths = get_mission_paths(args.path)
+	if len(mission_paths) > 1:
+		if args.list_included or args.list_excluded or args.verify is not None:
+			error("listing and verifying only work with a single mission")
+		if args.where or args.diff or args.diff_out or args.near or args.changes:
+			error("'--where', '--diff', '--diff_out', '--near' and '--changes' only work with a single mission")
+		ok = pack_batch(mission_paths)
+		sys.exit(0 if ok else 1)
+
+	# like in batch mode, the mission is handled from its own dir, where the
+	# files are packed from and the pk4 is written. The paths given are
+	# relative to the dir fmpak was run from
+	for name in ["pack_log", "diff", "diff_out", "verify"]:
+		if getattr(args, name):
+			setattr(args, name, os.path.abspath(getattr(args, name)))
+
+	set_fm_path(mission_paths[0])
 	validate_fm_path()
+	os.chdir(mission.path)
 	load_pkignore()
+
+	if can_stream_pack():
+		pack_fm(stream=True)
+		exit()
+
 	gather_files()
 
+	if args.base:
+		load_base_index(args.base)
+
+	if args.where:
+		report_references(args.where)
+		exit()
+
+	if args.diff:
+		report_pk4_diff(args.diff)
+		exit()
+
+	if args.near:
+		report_entities_near()
+		exit()
+
+	if args.changes:
+		parse_maps()
+		report_entity_changes()
+		exit()
+
 	if args.check:
-		if args.check in ["all"] + VALIDATION_PARAMS:
-			validate_mission_files()
-		else:
-			check_entity_properties()
+		run_checks()
 		# else:
 		# 	echo("wrong params for check - TODO proper error message")
 			# arg_parser.py: error: argument -c/--check: invalid choice: 'derp' (choose from 'foo', 'bar')
 		exit()
 
 
+	if args.verify is not None:
+		ok = verify_pk4(args.verify or mission.name + ".pk4")
+		sys.exit(0 if ok else 1)
+
 	if   args.list_included: check_files(args.list_included, mission.included, "Included files")
 	elif args.list_excluded: check_files(args.list_excluded, mission.excluded, "Excluded files")
 	else:                    pack_fm()